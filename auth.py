@@ -1,54 +1,175 @@
+from collections import namedtuple
+from datetime import timedelta
 from functools import wraps
 
+import asyncio
 import jwt
+import logging
+import time
 from sanic import text
-from sqlalchemy import select
+from sqlalchemy import select, func
 
+from cache import TTLCache
 from models import User
+from settings import settings, async_session_factory
 
+logger = logging.getLogger(__name__)
 
-def check_token(request):
+UserState = namedtuple("UserState", ["id", "activated", "superuser"])
+
+# Per worker caches: decoded claims by token and user flags by user id
+token_cache = TTLCache(settings["AUTH_CACHE_SIZE"], settings["AUTH_CACHE_TTL"])
+user_cache = TTLCache(settings["AUTH_CACHE_SIZE"], settings["AUTH_CACHE_TTL"])
+
+
+class TokenVersions:
+    """
+    user_id -> token_version of users that ever had their tokens revoked.
+    Bumped locally on change and refreshed from the DB for other workers.
+    """
+
+    def __init__(self):
+        self.versions = {}
+        self.since = None
+
+    def is_current(self, user_id, version):
+        return self.versions.get(user_id, 0) <= version
+
+    def set(self, user_id, version):
+        self.versions[int(user_id)] = max(version, self.versions.get(int(user_id), 0))
+
+    async def refresh(self, session):
+        stmt = select(User.id, User.token_version).where(User.token_version > 0)
+        if self.since is not None:
+            stmt = stmt.where(User.updated_at >= self.since)
+        async with session.begin():
+            result = await session.execute(select(func.now()))
+            now = result.scalar()
+            result = await session.execute(stmt)
+            for user_id, version in result:
+                self.set(user_id, version)
+        # updated_at is the writer's transaction start, it can commit later
+        self.since = now - VERSIONS_OVERLAP
+
+
+VERSIONS_OVERLAP = timedelta(minutes=1)
+
+token_versions = TokenVersions()
+
+
+def issue_token(user, secret, ttl):
+    claims = {
+        "user_id": user.id,
+        "activated": user.activated,
+        "superuser": user.superuser,
+        "ver": user.token_version,
+        "exp": int(time.time()) + ttl,
+    }
+    return jwt.encode(claims, secret)
+
+
+def decode_token(request):
     if not request.token:
         return False
-    try:
-        jwt.decode(request.token, request.app.config.SECRET, algorithms=["HS256"])
-    except jwt.exceptions.InvalidTokenError:
-        return False
-    else:
-        return True
+    if hasattr(request.ctx, "token_info"):
+        return request.ctx.token_info
+
+    token_info = token_cache.get(request.token)
+    if token_info and token_info.get("exp", float("inf")) < time.time():
+        token_cache.invalidate(request.token)
+        token_info = None
+    if token_info is None:
+        try:
+            token_info = jwt.decode(
+                request.token, request.app.config.SECRET, algorithms=["HS256"]
+            )
+        except jwt.exceptions.InvalidTokenError:
+            token_info = False
+        else:
+            token_cache.set(request.token, token_info)
+
+    request.ctx.token_info = token_info
+    return token_info
+
+
+def check_token(request):
+    return bool(decode_token(request))
 
 
 async def get_info_from_token(request):
-    if not request.token:
-        return False
-    try:
-        return jwt.decode(
-            request.token, request.app.config.SECRET, algorithms=["HS256"]
-        )
-    except jwt.exceptions.InvalidTokenError:
-        return False
+    return decode_token(request)
+
+
+async def get_user_state(request, user_id):
+    state = user_cache.get(user_id)
+    if state is None:
+        session = request.ctx.session
+        # Cached after a deactivation's invalidation, a replica could be stale
+        await session.use_primary()
+        async with session.transaction():
+            stmt = select(User.id, User.activated, User.superuser).where(
+                User.id == user_id
+            )
+            result = await session.execute(stmt)
+        row = result.first()
+        if row is None:
+            return None
+        state = UserState(*row)
+        user_cache.set(user_id, state)
+    return state
+
+
+def invalidate_user(user_id):
+    user_cache.invalidate(int(user_id))
+
+
+def auth_cache_stats():
+    return {"tokens": token_cache.stats(), "users": user_cache.stats()}
 
 
 def protected(wrapped):
     def decorator(f):
         @wraps(f)
         async def decorated_function(request, *args, **kwargs):
-            is_authenticated = check_token(request)
-
-            if is_authenticated:
-                token_info = await get_info_from_token(request)
-                session = request.ctx.session
-                async with session.begin():
-                    stmt = select(User).where(User.id == token_info["user_id"])
-                    result = await session.execute(stmt)
-                    await session.close()
-                user = result.scalar()
-                if user.activated:
-                    response = await f(request, *args, **kwargs)
-                    return response
+            token_info = decode_token(request)
+
+            if token_info and "ver" in token_info:
+                # Self-contained token, no query unless revoked meanwhile
+                if token_versions.is_current(token_info["user_id"], token_info["ver"]):
+                    user = UserState(
+                        token_info["user_id"],
+                        token_info["activated"],
+                        token_info["superuser"],
+                    )
+                else:
+                    user = None
+            elif token_info and "user_id" in token_info:
+                user = await get_user_state(request, token_info["user_id"])
+            else:
+                user = None
+
+            if user and user.activated:
+                request.ctx.user = user
+                response = await f(request, *args, **kwargs)
+                return response
 
             return text("You are unauthorized.", 401)
 
         return decorated_function
 
     return decorator(wrapped)
+
+
+def setup_auth(app):
+    @app.after_server_start
+    async def refresh_token_versions(app, loop):
+        async def refresh():
+            while True:
+                try:
+                    async with async_session_factory() as session:
+                        await token_versions.refresh(session)
+                except Exception:
+                    logger.exception("Token versions refresh failed")
+                await asyncio.sleep(app.config.TOKEN_VERSION_REFRESH)
+
+        app.add_task(refresh(), name="token_versions_refresh")
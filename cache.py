@@ -0,0 +1,166 @@
+from collections import OrderedDict, namedtuple
+
+import hashlib
+import pickle
+import time
+
+from serializers import dumps
+
+
+class TTLCache:
+    """LRU cache with per-entry expiry, local to the worker process."""
+
+    def __init__(self, maxsize=1024, ttl=60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+
+    def get(self, key, default=None):
+        item = self._data.get(key)
+        if item is not None:
+            expires, value = item
+            if expires > time.monotonic():
+                self._data.move_to_end(key)
+                self.hits += 1
+                return value
+            del self._data[key]
+        self.misses += 1
+        return default
+
+    def set(self, key, value):
+        self._data[key] = (time.monotonic() + self.ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def invalidate(self, key):
+        self._data.pop(key, None)
+
+    def clear(self):
+        self._data.clear()
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "size": len(self._data),
+            "maxsize": self.maxsize,
+            "ttl": self.ttl,
+        }
+
+
+class LocalCacheBackend:
+    """Default backend, entries are only seen by the current worker."""
+
+    def __init__(self, maxsize=1024, ttl=60):
+        self._cache = TTLCache(maxsize, ttl)
+        self._counters = {}
+
+    async def get(self, key):
+        return self._cache.get(key)
+
+    async def set(self, key, value):
+        self._cache.set(key, value)
+
+    async def delete(self, key):
+        self._cache.invalidate(key)
+
+    async def get_counter(self, key):
+        return self._counters.get(key, 0)
+
+    async def incr(self, key):
+        self._counters[key] = self._counters.get(key, 0) + 1
+        return self._counters[key]
+
+    def stats(self):
+        return {"backend": "local", **self._cache.stats()}
+
+
+class RedisCacheBackend:
+    """Shared between workers, needs the optional redis package."""
+
+    def __init__(self, url, ttl=60):
+        try:
+            import redis.asyncio as redis
+        except ImportError:
+            raise RuntimeError("redis package is required for a shared cache.")
+        self._redis = redis.from_url(url)
+        self.ttl = ttl
+
+    async def get(self, key):
+        value = await self._redis.get(key)
+        return pickle.loads(value) if value is not None else None
+
+    async def set(self, key, value):
+        await self._redis.set(key, pickle.dumps(value), ex=self.ttl)
+
+    async def delete(self, key):
+        await self._redis.delete(key)
+
+    async def get_counter(self, key):
+        value = await self._redis.get(key)
+        return int(value) if value is not None else 0
+
+    async def incr(self, key):
+        return await self._redis.incr(key)
+
+    def stats(self):
+        return {"backend": "redis"}
+
+
+def cache_backend(url, maxsize=1024, ttl=60):
+    if url:
+        return RedisCacheBackend(url, ttl)
+    return LocalCacheBackend(maxsize, ttl)
+
+
+CachedResponse = namedtuple("CachedResponse", ["body", "etag", "headers"])
+
+
+class ResponseCache:
+    """
+    Read-through cache of serialised JSON bodies. Keys are prefixed with a
+    version counter, so bump_version() drops every entry of the namespace.
+    """
+
+    def __init__(self, namespace, backend):
+        self.namespace = namespace
+        self.backend = backend
+        self.hits = 0
+        self.misses = 0
+
+    async def _key(self, key):
+        version = await self.backend.get_counter(f"{self.namespace}:version")
+        return f"{self.namespace}:{version}:{key}"
+
+    async def get_or_load(self, key, load, headers=None):
+        """
+        load() returns the data to serialise, or None to skip caching.
+        headers(data) returns extra response headers stored with the body.
+        """
+        full_key = await self._key(key)
+        entry = await self.backend.get(full_key)
+        if entry is not None:
+            self.hits += 1
+            return entry
+
+        self.misses += 1
+        data = await load()
+        if data is None:
+            return None
+        body = dumps(data)
+        etag = f'"{hashlib.sha1(body).hexdigest()}"'
+        entry = CachedResponse(body, etag, headers(data) if headers else {})
+        await self.backend.set(full_key, entry)
+        return entry
+
+    async def invalidate(self, key):
+        await self.backend.delete(await self._key(key))
+
+    async def bump_version(self):
+        await self.backend.incr(f"{self.namespace}:version")
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, **self.backend.stats()}
@@ -1,163 +1,377 @@
+from collections import defaultdict
+from operator import itemgetter
 from typing import List
-from sqlalchemy import select, update, delete
+from sqlalchemy import (
+    select,
+    update,
+    delete,
+    func,
+    literal,
+    union_all,
+    cast,
+    Float,
+    Integer,
+)
+from sqlalchemy.dialects.postgresql import insert as pg_insert
 from sqlalchemy.orm import selectinload
 from sanic.exceptions import SanicException
 
-from auth import get_info_from_token
-from utils import fake_encode_password
-from models import User, Product, Transaction, Account
-
-
-import traceback
+from auth import decode_token, invalidate_user, token_versions
+from cache import ResponseCache, CachedResponse, cache_backend
+from settings import settings
+from serializers import rows_to_dicts
+from passwords import password_hasher
+from utils import next_page_headers, make_version, merge_sorted
+from partitions import (
+    archived_blocks,
+    archived_ids,
+    is_archived,
+    lock_archived_ranges,
+    read_archived_blocks,
+    read_archived_transactions,
+)
+from models import (
+    User,
+    Product,
+    Transaction,
+    TransactionArchiveBill,
+    Account,
+    Purchase,
+    UserTotals,
+)
+
+import heapq
 import logging
 
+logger = logging.getLogger(__name__)
+
 # Utils
 
 
+# Columns selected for list responses, as plain rows instead of ORM entities
+USER_COLUMNS = (User.id, User.login, User.activated, User.superuser)
+PRODUCT_COLUMNS = (Product.id, Product.title, Product.description, Product.price)
+PRODUCT_FIELDS = ("title", "description", "price")
+TRANSACTION_COLUMNS = (Transaction.id, Transaction.bill_id, Transaction.amount)
+
+
+async def stream_rows(request, stmt, prepare=None):
+    """
+    Server-side cursor, fetched in STREAM_CHUNK_SIZE batches of dicts.
+    prepare(session, rows) can complete each batch before it is yielded.
+    """
+    chunk_size = request.app.config.STREAM_CHUNK_SIZE
+    session = request.ctx.session
+    async with session.transaction():
+        result = await session.stream(stmt.execution_options(yield_per=chunk_size))
+        async for partition in result.partitions(chunk_size):
+            rows = rows_to_dicts(partition)
+            if prepare:
+                await prepare(session, rows)
+            for row in rows:
+                yield row
+
+
 async def is_super_user(request):
-    curr_user = await get_current_user(request)
+    if hasattr(request.ctx, "user"):
+        return request.ctx.user.superuser
+    curr_user = await get_current_user(request, accounts=False)
     return curr_user.superuser
 
 
 # Users
 
 
-async def get_users(request) -> List[User]:
+async def attach_balances(session, users):
+    """Same accounts shape as User.to_dict, one query for the whole batch."""
+    accounts = {user["id"]: [] for user in users}
+    if accounts:
+        stmt = (
+            select(Account.user_id, Account.balance)
+            .where(Account.user_id.in_(accounts))
+            .order_by(Account.id)
+        )
+        for user_id, balance in await session.execute(stmt):
+            accounts[user_id].append({"balance": balance})
+    for user in users:
+        user["accounts"] = accounts[user["id"]]
+
+
+async def get_users(request, after_id=0, limit=None) -> List[dict]:
+    session = request.ctx.session
+    async with session.transaction():
+        stmt = (
+            select(*USER_COLUMNS)
+            .where(User.id > after_id)
+            .order_by(User.id)
+            .limit(limit)
+        )
+        users = rows_to_dicts(await session.execute(stmt))
+        await attach_balances(session, users)
+    return users
+
+
+async def stream_users(request):
+    stmt = select(*USER_COLUMNS).order_by(User.id)
+    async for user in stream_rows(request, stmt, prepare=attach_balances):
+        yield user
+
+
+def _loaded_users(request):
+    """Request scoped identity map: user_id -> (User or None, accounts loaded)."""
+    if not hasattr(request.ctx, "users"):
+        request.ctx.users = {}
+    return request.ctx.users
+
+
+async def load_user(request, pk=None, accounts=False, where=None) -> User:
+    """
+    Every user accessor goes through here, so a request issues at most one
+    query per user, plus one for the accounts when a handler needs them.
+    where looks the user up by another unique column instead of pk.
+    """
+    users = _loaded_users(request)
+    if where is None:
+        pk = int(pk)
+        if pk in users:
+            user, has_accounts = users[pk]
+            if user is None or has_accounts or not accounts:
+                return user
+        where = User.id == pk
+
     session = request.ctx.session
-    async with session.begin():
-        stmt = select(User).options(selectinload(User.accounts))
+    async with session.transaction():
+        stmt = select(User).where(where)
+        if accounts:
+            stmt = stmt.options(selectinload(User.accounts))
         result = await session.execute(stmt)
-    return result.scalars().all()
+    user = result.scalar()
+    if user is not None:
+        pk = user.id
+    if pk is not None:
+        has_accounts = pk in users and users[pk][0] is user and users[pk][1]
+        users[pk] = (user, accounts or has_accounts)
+    return user
+
+
+def get_current_user_id(request):
+    if hasattr(request.ctx, "user"):
+        return request.ctx.user.id
+    token_info = decode_token(request)
+    if token_info and "user_id" in token_info:
+        return token_info["user_id"]
 
 
 async def get_user_by_request(request) -> User:
-    token_info = get_info_from_token(request)
-    if token_info:
-        user_id = token_info["user_id"]
-        session = request.ctx.session
-        async with session.begin():
-            stmt = (
-                select(User)
-                .where(User.id == user_id)
-                .options(selectinload(User.accounts))
-            )
-            result = await session.execute(stmt)
-        return result.scalar()
+    user_id = get_current_user_id(request)
+    if user_id is not None:
+        return await load_user(request, user_id, accounts=True)
 
 
-async def get_current_user(request):
-    current_user = await get_info_from_token(request)
-    if current_user and "user_id" in current_user:
-        user = await get_user_by_id(request, current_user["user_id"])
+async def get_current_user(request, accounts=True):
+    user_id = get_current_user_id(request)
+    if user_id is not None:
+        user = await load_user(request, user_id, accounts)
         if user:
             return user
     raise SanicException("You are unauthorized.", status_code=401)
 
 
-async def get_user_by_username(request, username) -> User:
+async def get_user_version(request, pk):
+    """Validator of a user and its accounts, without loading them."""
     session = request.ctx.session
-    async with session.begin():
+    async with session.transaction():
         stmt = (
-            select(User)
-            .where(User.login == username)
-            .options(selectinload(User.accounts))
+            select(func.coalesce(UserTotals.version, 0))
+            .select_from(User)
+            .outerjoin(UserTotals, UserTotals.user_id == User.id)
+            .where(User.id == pk)
         )
         result = await session.execute(stmt)
-    return result.scalar()
+    row = result.first()
+    if row:
+        return make_version(f"user-{pk}", row[0])
 
 
-async def get_user_by_id(request, pk) -> User:
-    session = request.ctx.session
-    async with session.begin():
-        stmt = select(User).where(User.id == pk).options(selectinload(User.accounts))
-        result = await session.execute(stmt)
-        user = result.scalar()
-    return user
+async def get_user_by_username(request, username, accounts=False) -> User:
+    return await load_user(request, accounts=accounts, where=User.login == username)
 
 
-async def get_user_by_link(request, link) -> User:
-    session = request.ctx.session
-    async with session.begin():
-        stmt = (
-            select(User)
-            .where(User.activate_link == link)
-            .options(selectinload(User.accounts))
-        )
-        result = await session.execute(stmt)
-    return result.scalar()
+async def get_user_by_id(request, pk, accounts=True) -> User:
+    return await load_user(request, pk, accounts)
+
+
+async def get_user_by_link(request, link, accounts=False) -> User:
+    return await load_user(request, accounts=accounts, where=User.activate_link == link)
 
 
 async def create_user(request, user: User):
+    user.password = await password_hasher.hash(user.password)
     session = request.ctx.session
-    async with session.begin():
-        user.password = fake_encode_password(user.password)
+    async with session.transaction():
         if not user.accounts:
             acc = Account()
             user.accounts = [acc]
         session.add_all([user])
+        # activate_link is needed before the request transaction commits
+        await session.flush()
     return user
 
 
 async def activate_user(request, user: User):
-    session = request.ctx.session
-    async with session.begin():
-        user.activated = True
-        session.commit()
+    await admin_activate_user(request, user.id, True)
+    # No token yet, read-your-writes stickiness needs the user id
+    request.ctx.writer_id = user.id
+    user.activated = True
     return user
 
 
-async def admin_activate_user(request, user_id, activate: bool):
+async def update_user_password(request, user_id, encoded_password):
     session = request.ctx.session
-    async with session.begin():
-        stmt = update(User).where(User.id == user_id).values(activated=activate)
+    async with session.transaction():
+        stmt = update(User).where(User.id == user_id).values(password=encoded_password)
         await session.execute(stmt)
 
 
+async def admin_activate_user(request, user_id, activate: bool):
+    session = request.ctx.session
+    async with session.transaction():
+        stmt = (
+            update(User)
+            .where(User.id == user_id)
+            .values(activated=activate, token_version=User.token_version + 1)
+            .returning(User.token_version)
+        )
+        result = await session.execute(stmt)
+        version = result.scalar()
+        if version is not None:
+            await session.execute(bump_user_version(user_id))
+
+    def invalidate():
+        invalidate_user(user_id)
+        if version is not None:
+            token_versions.set(user_id, version)
+
+    await session.after_commit(invalidate)
+
+
 # Products
 
 
+def product_cache_ttl(config):
+    if config["PRODUCT_CACHE_URL"] or config["WORKERS"] <= 1:
+        return config["PRODUCT_CACHE_TTL"]
+    # Other workers would serve stale prices until their entries expire
+    return min(config["PRODUCT_CACHE_TTL"], config["LOCAL_CACHE_MAX_TTL"])
+
+
+product_cache = ResponseCache(
+    "products",
+    cache_backend(
+        settings["PRODUCT_CACHE_URL"],
+        settings["PRODUCT_CACHE_SIZE"],
+        product_cache_ttl(settings),
+    ),
+)
+
+
 async def get_product_by_id(request, pk) -> Product:
     session = request.ctx.session
-    async with session.begin():
+    async with session.transaction():
         stmt = select(Product).where(Product.id == pk)
         result = await session.execute(stmt)
     return result.scalar()
 
 
-async def get_products(request) -> List[Product]:
+async def get_products(request, after_id=0, limit=None) -> List[dict]:
     session = request.ctx.session
-    async with session.begin():
-        stmt = select(Product)
+    async with session.transaction():
+        stmt = (
+            select(*PRODUCT_COLUMNS)
+            .where(Product.id > after_id)
+            .order_by(Product.id)
+            .limit(limit)
+        )
         result = await session.execute(stmt)
-    return result.scalars().all()
+    return rows_to_dicts(result)
+
+
+async def stream_products(request):
+    stmt = select(*PRODUCT_COLUMNS).order_by(Product.id)
+    async for product in stream_rows(request, stmt):
+        yield product
+
+
+async def get_cached_product(request, pk) -> CachedResponse:
+    async def load():
+        await request.ctx.session.use_primary()
+        product = await get_product_by_id(request, pk)
+        return product.to_dict() if product else None
+
+    return await product_cache.get_or_load(f"item:{pk}", load)
+
+
+async def get_cached_products(request, after_id=0, limit=None) -> CachedResponse:
+    async def load():
+        await request.ctx.session.use_primary()
+        prods = await get_products(request, after_id, limit)
+        return prods if prods else {}
+
+    return await product_cache.get_or_load(
+        f"list:{after_id}:{limit}",
+        load,
+        headers=lambda data: next_page_headers(data, limit),
+    )
 
 
 async def add_product(request, product: Product):
     session = request.ctx.session
-    async with session.begin():
+    async with session.transaction():
         session.add(product)
+    await session.after_commit(product_cache.bump_version)
 
 
-async def update_product(request, id, json_dict):
+async def update_product(request, id, json_dict) -> dict:
+    """
+    Updates only the PRODUCT_FIELDS present in json_dict.
+    Returns the updated product, or None if it doesn't exist.
+    """
+    values = {key: json_dict[key] for key in PRODUCT_FIELDS if key in json_dict}
     session = request.ctx.session
-    async with session.begin():
+    async with session.transaction():
         stmt = (
             update(Product)
             .where(Product.id == id)
-            .values(
-                title=json_dict["title"],
-                description=json_dict["description"],
-                price=json_dict["price"],
-            )
+            .values(**values)
+            .returning(*PRODUCT_COLUMNS)
+            .execution_options(synchronize_session=False)
         )
-        await session.execute(stmt)
+        result = await session.execute(stmt)
+        row = result.first()
+    if row is None:
+        return None
+    await session.after_commit(lambda: product_cache.invalidate(f"item:{id}"))
+    await session.after_commit(product_cache.bump_version)
+    return row._asdict()
 
 
-async def delete_product(request, product_id):
+async def delete_product(request, product_id) -> bool:
     session = request.ctx.session
-    async with session.begin():
-        stmt = delete(Product).where(Product.id == product_id)
-        await session.execute(stmt)
+    async with session.transaction():
+        stmt = (
+            delete(Product)
+            .where(Product.id == product_id)
+            .returning(Product.id)
+            .execution_options(synchronize_session=False)
+        )
+        result = await session.execute(stmt)
+        deleted = result.first() is not None
+    if deleted:
+        await session.after_commit(
+            lambda: product_cache.invalidate(f"item:{product_id}")
+        )
+        await session.after_commit(product_cache.bump_version)
+    return deleted
 
 
 # Accounts
@@ -165,15 +379,23 @@ async def delete_product(request, product_id):
 
 async def get_accounts_by_user(request, user: User) -> List[Account]:
     session = request.ctx.session
-    async with session.begin():
+    async with session.transaction():
         stmt = select(Account).where(Account.user_id == user.id)
         result = await session.execute(stmt)
     return result.scalars().all()
 
 
+async def get_accounts_version(request, user_id):
+    session = request.ctx.session
+    async with session.transaction():
+        stmt = select(UserTotals.version).where(UserTotals.user_id == user_id)
+        result = await session.execute(stmt)
+    return make_version(f"accounts-{user_id}", result.scalar() or 0)
+
+
 async def get_account_by_id(request, pk) -> Account:
     session = request.ctx.session
-    async with session.begin():
+    async with session.transaction():
         stmt = select(Account).where(Account.id == pk)
         result = await session.execute(stmt)
     return result.scalar()
@@ -181,32 +403,322 @@ async def get_account_by_id(request, pk) -> Account:
 
 async def update_account(request, id, amount):
     session = request.ctx.session
-    async with session.begin():
-        stmt = update(Account).where(Account.id == id).values(balance=amount)
+    async with session.transaction():
+        stmt = (
+            update(Account)
+            .where(Account.id == id)
+            .values(balance=amount)
+            .returning(Account.user_id)
+        )
+        result = await session.execute(stmt)
+        user_id = result.scalar()
+        if user_id is not None:
+            await session.execute(bump_user_version(user_id))
+
+
+# Purchases
+
+
+async def buy_product(request, user_id, account_id, product_id) -> Purchase:
+    """
+    Conditional decrement in one statement, so concurrent buys on the same
+    account can't overdraw it or lose an update.
+    Returns None if the account isn't the user's, the product doesn't exist
+    or the balance is too low.
+    """
+    session = request.ctx.session
+    async with session.transaction():
+        stmt = (
+            update(Account)
+            .where(
+                Account.id == account_id,
+                Account.user_id == user_id,
+                Product.id == product_id,
+                Account.balance >= Product.price,
+            )
+            .values(balance=Account.balance - Product.price)
+            .returning(Account.balance, Product.price)
+            .execution_options(synchronize_session=False)
+        )
+        result = await session.execute(stmt)
+        row = result.first()
+        if row is None:
+            return None
+        purchase = Purchase(
+            account_id=account_id, product_id=product_id, price=row.price
+        )
+        session.add(purchase)
+        await session.flush()
+        stmt = totals_upsert(
+            pg_insert(UserTotals).values(
+                user_id=user_id,
+                balance=-row.price,
+                purchases_count=1,
+                purchases_amount=row.price,
+            )
+        )
         await session.execute(stmt)
+    return purchase
 
 
-# Transactions
+# Totals
+
+TOTALS_COUNTERS = (
+    "balance",
+    "transactions_count",
+    "transactions_amount",
+    "purchases_count",
+    "purchases_amount",
+)
+
+
+def totals_upsert(stmt):
+    """ON CONFLICT adds the inserted deltas to the stored totals."""
+    return stmt.on_conflict_do_update(
+        index_elements=[UserTotals.user_id],
+        set_={
+            **{
+                name: getattr(UserTotals, name) + getattr(stmt.excluded, name)
+                for name in TOTALS_COUNTERS
+            },
+            "version": UserTotals.version + 1,
+        },
+    )
+
+
+def bump_user_version(user_id):
+    """For writes that change a user or its accounts but none of the totals."""
+    return totals_upsert(pg_insert(UserTotals).values(user_id=user_id))
 
 
-async def get_transactions_by_user(request, user: User) -> List[Transaction]:
+def transactions_by_bill(bill_ids=None):
+    """
+    Count and amount per bill_id over live rows and archived partitions,
+    restricted to bill_ids (a select of Account.id) when given.
+    """
+    live = select(
+        Transaction.bill_id,
+        func.count(Transaction.id).label("count"),
+        func.sum(Transaction.amount).label("amount"),
+    ).group_by(Transaction.bill_id)
+    archived = select(
+        TransactionArchiveBill.bill_id,
+        TransactionArchiveBill.count,
+        TransactionArchiveBill.amount,
+    )
+    if bill_ids is not None:
+        live = live.where(Transaction.bill_id.in_(bill_ids))
+        archived = archived.where(TransactionArchiveBill.bill_id.in_(bill_ids))
+    rows = union_all(live, archived).subquery()
+    return (
+        select(
+            rows.c.bill_id,
+            cast(func.sum(rows.c.count), Integer).label("count"),
+            func.sum(rows.c.amount).label("amount"),
+        )
+        .group_by(rows.c.bill_id)
+        .subquery()
+    )
+
+
+async def rebuild_user_totals(session):
+    """
+    Recomputes every row from the source tables, e.g. after seeding.
+    Takes a session or a connection.
+    """
+    balances = (
+        select(Account.user_id, func.sum(Account.balance).label("balance"))
+        .where(Account.user_id.isnot(None))
+        .group_by(Account.user_id)
+        .subquery()
+    )
+    by_bill = transactions_by_bill()
+    transactions = (
+        select(
+            Account.user_id,
+            func.sum(by_bill.c.count).label("count"),
+            func.sum(by_bill.c.amount).label("amount"),
+        )
+        .join(Account, Account.id == by_bill.c.bill_id)
+        .group_by(Account.user_id)
+        .subquery()
+    )
+    purchases = (
+        select(
+            Account.user_id,
+            func.count(Purchase.id).label("count"),
+            func.sum(Purchase.price).label("amount"),
+        )
+        .join(Account, Account.id == Purchase.account_id)
+        .group_by(Account.user_id)
+        .subquery()
+    )
+    stmt = pg_insert(UserTotals).from_select(
+        ["user_id", *TOTALS_COUNTERS],
+        select(
+            balances.c.user_id,
+            balances.c.balance,
+            func.coalesce(transactions.c.count, 0),
+            func.coalesce(transactions.c.amount, 0),
+            func.coalesce(purchases.c.count, 0),
+            func.coalesce(purchases.c.amount, 0),
+        )
+        .outerjoin(transactions, transactions.c.user_id == balances.c.user_id)
+        .outerjoin(purchases, purchases.c.user_id == balances.c.user_id),
+    )
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[UserTotals.user_id],
+        set_={
+            **{name: getattr(stmt.excluded, name) for name in TOTALS_COUNTERS},
+            "version": UserTotals.version + 1,
+        },
+    )
+    await session.execute(stmt)
+
+
+async def get_user_totals(request, user_id) -> dict:
     session = request.ctx.session
-    async with session.begin():
+    async with session.transaction():
+        stmt = select(UserTotals).where(UserTotals.user_id == user_id)
+        result = await session.execute(stmt)
+    totals = result.scalar()
+    if totals is None:
+        return UserTotals(**dict.fromkeys(TOTALS_COUNTERS, 0)).to_dict()
+    return totals.to_dict()
 
-        accounts_smtp = select(Account).where(Account.user_id == user.id)
-        result = await session.execute(accounts_smtp)
-        accounts = result.scalars().all()
 
-        stmt = select(Transaction).where(
-            Transaction.bill_id.in_([acc.id for acc in accounts])
+async def get_accounts_summary(request, user_id) -> dict:
+    session = request.ctx.session
+    async with session.transaction():
+        stmt = select(
+            func.count(Account.id), func.coalesce(func.sum(Account.balance), 0)
+        ).where(Account.user_id == user_id)
+        result = await session.execute(stmt)
+    count, balance = result.first()
+    return {"accounts": count, "balance": balance}
+
+
+async def get_transactions_summary_by_account(request, user_id) -> List[dict]:
+    """Grouped over the history, for the per account breakdown only."""
+    session = request.ctx.session
+    async with session.transaction():
+        summary = transactions_by_bill(
+            select(Account.id).where(Account.user_id == user_id)
         )
+        stmt = select(summary).order_by(summary.c.bill_id)
         result = await session.execute(stmt)
-    return result.scalars().all()
+    return rows_to_dicts(result)
+
+
+# Transactions
+
+
+def transactions_by_user_stmt(user_id):
+    return (
+        select(*TRANSACTION_COLUMNS)
+        .join(Account, Account.id == Transaction.bill_id)
+        .where(Account.user_id == user_id)
+        .order_by(Transaction.id)
+    )
+
+
+async def get_transactions_by_user(
+    request, user: User, after_id=0, limit=None
+) -> List[dict]:
+    """
+    Archived and live rows merged by id: new ids can be credited into an
+    archived range, so the live rows don't all follow the archived ones.
+    """
+    session = request.ctx.session
+    async with session.transaction():
+        archived = await read_archived_transactions(session, user.id, after_id, limit)
+        stmt = (
+            transactions_by_user_stmt(user.id)
+            .where(Transaction.id > after_id)
+            .limit(limit)
+        )
+        result = await session.execute(stmt)
+        live = rows_to_dicts(result)
+    transactions = list(heapq.merge(archived, live, key=itemgetter("id")))
+    return transactions if limit is None else transactions[:limit]
+
+
+async def stream_transactions_by_user(request, user: User):
+    session = request.ctx.session
+    async with session.transaction():
+        blocks = await archived_blocks(session, user.id)
+    async for trx in merge_sorted(
+        itemgetter("id"),
+        read_archived_blocks(blocks),
+        stream_rows(request, transactions_by_user_stmt(user.id)),
+    ):
+        yield trx
 
 
 # Payments
 
 
+def payment_statement(json_dict):
+    """
+    WITH trx AS (INSERT INTO transaction ... ON CONFLICT DO NOTHING RETURNING ...),
+    acc AS (INSERT INTO account ... SELECT FROM trx
+            ON CONFLICT (id) DO UPDATE SET balance = account.balance + ...),
+    tot AS (INSERT INTO user_totals ... SELECT FROM acc, trx ON CONFLICT ...
+            RETURNING version)
+    SELECT id, balance, (SELECT version FROM tot) FROM acc
+
+    A repeated transaction_id inserts nothing, so neither the account nor the
+    totals are touched and no row is returned. Same for an archived one,
+    after lock_archived_ranges.
+    """
+    trx_id = literal(json_dict["transaction_id"], Integer)
+    trx = (
+        pg_insert(Transaction)
+        .from_select(
+            ["id", "bill_id", "amount"],
+            select(
+                trx_id,
+                literal(json_dict["bill_id"], Integer),
+                literal(json_dict["amount"], Float),
+            ).where(~is_archived(trx_id)),
+        )
+        .on_conflict_do_nothing(index_elements=[Transaction.id])
+        .returning(Transaction.bill_id, Transaction.amount)
+        .cte("trx")
+    )
+    user_id = select(User.id).where(User.id == json_dict["user_id"])
+    stmt = pg_insert(Account).from_select(
+        ["id", "user_id", "balance"],
+        select(trx.c.bill_id, user_id.scalar_subquery(), trx.c.amount),
+    )
+    acc = (
+        stmt.on_conflict_do_update(
+            index_elements=[Account.id],
+            set_={
+                "balance": Account.balance + stmt.excluded.balance,
+                "updated_at": func.now(),
+            },
+        )
+        .returning(Account.id, Account.user_id, Account.balance)
+        .cte("acc")
+    )
+    tot = (
+        totals_upsert(
+            pg_insert(UserTotals).from_select(
+                ["user_id", "balance", "transactions_count", "transactions_amount"],
+                select(acc.c.user_id, trx.c.amount, literal(1), trx.c.amount).where(
+                    acc.c.id == trx.c.bill_id, acc.c.user_id.isnot(None)
+                ),
+            )
+        )
+        .returning(UserTotals.version)
+        .cte("tot")
+    )
+    # Selected, an unreferenced CTE is left out of the compiled statement
+    version = select(tot.c.version).scalar_subquery().label("version")
+    return select(acc.c.id, acc.c.balance, version)
+
+
 async def make_payment_webhook(request, json_dict):
     """
     private_key: приватный ключ, задаётся в свойствах приложения,
@@ -214,35 +726,160 @@ async def make_payment_webhook(request, json_dict):
     user_id: пользователь на чеё счёт произойдёт зачисление,
     bill_id: идентификатор счёта (если счёта c таким айди не существует, то но должен быть создан),
     amount: сумма транзакции
+
+    Returns "credited", "duplicate" for an already applied transaction_id,
+    or None on error.
+
+    The credit is the one payment_statement(), the archived check included.
+    The lock of the id's range must be a statement of its own: a lookup in
+    the same statement would use a snapshot taken before the lock is granted
+    and miss an archive committed meanwhile, crediting its id again.
     """
 
     session = request.ctx.session
-    async with session.begin():
+    try:
+        async with session.transaction(savepoint=True):
+            # One round trip, the shared lock only waits for a running archive
+            await lock_archived_ranges(session, [json_dict["transaction_id"]])
+            result = await session.execute(payment_statement(json_dict))
+            row = result.first()
+    except Exception:
+        logger.exception(
+            "Payment webhook failed for transaction %s", json_dict["transaction_id"]
+        )
+        return None
+    return "credited" if row else "duplicate"
+
+
+async def apply_payment_batch(session, items):
+    """
+    Applies already verified payloads in the session's transaction: a multi-row
+    insert of transactions, then one upsert of the summed amounts per bill_id.
+    Returns a status per item, in order.
+    """
+    statuses = []
+    transactions = {}
+    for json_dict in items:
+        if json_dict["transaction_id"] in transactions:
+            statuses.append("duplicate")
+        else:
+            transactions[json_dict["transaction_id"]] = json_dict
+            statuses.append(None)
+    if not transactions:
+        return statuses
+
+    await lock_archived_ranges(session, transactions)
+    for trx_id in await archived_ids(session, list(transactions)):
+        del transactions[trx_id]
+    if not transactions:
+        return [status or "duplicate" for status in statuses]
+
+    stmt = (
+        pg_insert(Transaction)
+        .values(
+            [
+                {
+                    "id": trx["transaction_id"],
+                    "bill_id": trx["bill_id"],
+                    "amount": trx["amount"],
+                }
+                for trx in transactions.values()
+            ]
+        )
+        .on_conflict_do_nothing(index_elements=[Transaction.id])
+        .returning(Transaction.id)
+    )
+    result = await session.execute(stmt)
+    inserted = set(result.scalars().all())
+
+    deltas = {}
+    counts = defaultdict(int)
+    for trx_id in inserted:
+        trx = transactions[trx_id]
+        counts[trx["bill_id"]] += 1
+        if trx["bill_id"] in deltas:
+            deltas[trx["bill_id"]]["balance"] += trx["amount"]
+        else:
+            deltas[trx["bill_id"]] = {
+                "id": trx["bill_id"],
+                "user_id": select(User.id)
+                .where(User.id == trx["user_id"])
+                .scalar_subquery(),
+                "balance": trx["amount"],
+            }
+
+    if deltas:
+        # Sorted so concurrent batches lock accounts in the same order
+        stmt = pg_insert(Account).values(
+            [deltas[bill_id] for bill_id in sorted(deltas)]
+        )
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[Account.id],
+            set_={
+                "balance": Account.balance + stmt.excluded.balance,
+                "updated_at": func.now(),
+            },
+        ).returning(Account.id, Account.user_id)
+        result = await session.execute(stmt)
+
+        totals = {}
+        for bill_id, user_id in result:
+            if user_id is None:
+                continue
+            row = totals.setdefault(
+                user_id,
+                {
+                    "user_id": user_id,
+                    "balance": 0,
+                    "transactions_count": 0,
+                    "transactions_amount": 0,
+                },
+            )
+            row["balance"] += deltas[bill_id]["balance"]
+            row["transactions_amount"] += deltas[bill_id]["balance"]
+            row["transactions_count"] += counts[bill_id]
+        if totals:
+            stmt = pg_insert(UserTotals).values(
+                [totals[user_id] for user_id in sorted(totals)]
+            )
+            await session.execute(totals_upsert(stmt))
+
+    return [
+        status
+        or ("credited" if json_dict["transaction_id"] in inserted else "duplicate")
+        for status, json_dict in zip(statuses, items)
+    ]
+
+
+async def apply_payments_each(session, items, savepoint):
+    """
+    Fallback for a failed batch, each item in its own savepoint() so one bad
+    payload doesn't fail the rest. None is the status of a failed item.
+    """
+    statuses = []
+    for json_dict in items:
         try:
-            account_stmt = select(Account).where(Account.id == json_dict["bill_id"])
-            result = await session.execute(account_stmt)
-            account = result.scalar()
-            if account:
-                # and account in user.accounts?
-                account.balance = account.balance + json_dict["amount"]
-            else:
-                user_stmt = select(User).where(User.id == json_dict["user_id"])
-                result = await session.execute(user_stmt)
-                user = result.scalar()
-                account = Account(
-                    id=json_dict["bill_id"], user=user, balance=json_dict["amount"]
-                )
-                session.add(account)
-            # check transaction exists?
-            transaction = Transaction(
-                id=json_dict["transaction_id"],
-                bill_id=json_dict["bill_id"],
-                amount=json_dict["amount"],
+            async with savepoint():
+                statuses += await apply_payment_batch(session, [json_dict])
+        except Exception:
+            logger.exception(
+                "Payment webhook failed for transaction %s",
+                json_dict["transaction_id"],
             )
-            session.add(transaction)
-            await session.commit()
-            return True
-        except Exception as e:
-            await session.rollback()
-            logging.error(traceback.format_exc())
-            return False
+            statuses.append(None)
+    return statuses
+
+
+async def make_payment_webhook_batch(request, items):
+    """Returns a status per item, in order, None for the items that failed."""
+    session = request.ctx.session
+    try:
+        async with session.transaction(savepoint=True):
+            return await apply_payment_batch(session, items)
+    except Exception:
+        logger.exception(
+            "Payment webhook batch of %s failed, applying one by one", len(items)
+        )
+    return await apply_payments_each(
+        session, items, lambda: session.transaction(savepoint=True)
+    )
@@ -0,0 +1,234 @@
+from contextlib import asynccontextmanager
+from datetime import datetime
+from operator import itemgetter
+
+import asyncio
+import csv
+import io
+import zlib
+
+from sanic.exceptions import SanicException
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import sessionmaker
+
+from models import User, Account, Transaction
+from partitions import archives_in_range, iter_archive
+from serializers import dumps
+from settings import settings, bind
+from utils import merge_sorted
+
+# name: (columns, date column for since/until), the first column is the key
+EXPORTS = {
+    "transactions": (
+        (Transaction.id, Transaction.bill_id, Transaction.amount),
+        Transaction.created_at,
+    ),
+    "accounts": (
+        (Account.id, Account.user_id, Account.balance, Account.updated_at),
+        Account.updated_at,
+    ),
+    "users": (
+        (User.id, User.login, User.activated, User.superuser, User.updated_at),
+        User.updated_at,
+    ),
+}
+CONTENT_TYPES = {"csv": "text/csv; charset=utf-8", "ndjson": "application/x-ndjson"}
+
+
+class ExportParams:
+    __slots__ = ("name", "format", "gzip", "from_id", "to_id", "since", "until")
+
+    def __init__(self, name, format, gzip, from_id, to_id, since, until):
+        self.name = name
+        self.format = format
+        self.gzip = gzip
+        self.from_id = from_id
+        self.to_id = to_id
+        self.since = since
+        self.until = until
+
+    @classmethod
+    def from_request(cls, request, name):
+        """?format=csv|ndjson&gzip=1&from_id=&to_id=&since=&until= (ISO 8601)."""
+        args = request.args
+        fmt = args.get("format", "csv")
+        if fmt not in CONTENT_TYPES:
+            raise SanicException("format must be csv or ndjson.", status_code=400)
+        try:
+            from_id, to_id = (
+                int(args[key]) if args.get(key) else None
+                for key in ("from_id", "to_id")
+            )
+            since, until = (
+                datetime.fromisoformat(args[key]) if args.get(key) else None
+                for key in ("since", "until")
+            )
+        except ValueError:
+            raise SanicException(
+                "from_id and to_id must be integers, since and until ISO dates.",
+                status_code=400,
+            )
+        gzip = args.get("gzip", "").lower() in ("1", "true", "yes")
+        return cls(name, fmt, gzip, from_id, to_id, since, until)
+
+    @property
+    def filename(self):
+        return f"{self.name}.{self.format}" + (".gz" if self.gzip else "")
+
+
+def _value(value):
+    return value.isoformat() if isinstance(value, datetime) else value
+
+
+def encode_csv(rows):
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows(
+        ["" if value is None else _value(value) for value in row] for row in rows
+    )
+    return buffer.getvalue().encode()
+
+
+def encode_ndjson(keys, rows):
+    return b"".join(dumps(dict(zip(keys, map(_value, row)))) + b"\n" for row in rows)
+
+
+class Exporter:
+    """
+    Keyset chunks of chunk_rows, each read through a server-side cursor in its
+    own short read-only transaction, so an export never holds back vacuum for
+    its whole duration. Exports running at once are capped per worker.
+    """
+
+    def __init__(self, session_factory, chunk_rows, fetch_rows, max_running):
+        self.session_factory = session_factory
+        self.chunk_rows = chunk_rows
+        self.fetch_rows = fetch_rows
+        self.max_running = max_running
+        self.running = 0
+
+    @asynccontextmanager
+    async def _slot(self):
+        if self.running >= self.max_running:
+            raise SanicException(
+                "Too many exports running, try again later.", status_code=429
+            )
+        self.running += 1
+        try:
+            yield
+        finally:
+            self.running -= 1
+
+    def _chunk_stmt(self, params, after_id):
+        columns, date = EXPORTS[params.name]
+        key = columns[0]
+        stmt = select(*columns).order_by(key).limit(self.chunk_rows)
+        if after_id is not None:
+            stmt = stmt.where(key > after_id)
+        if params.to_id is not None:
+            stmt = stmt.where(key <= params.to_id)
+        if params.since is not None:
+            stmt = stmt.where(date >= params.since)
+        if params.until is not None:
+            stmt = stmt.where(date < params.until)
+        return stmt.execution_options(yield_per=self.fetch_rows)
+
+    async def _archived_rows(self, params):
+        if params.since is not None or params.until is not None:
+            # Archives keep no dates, a date filter covers the live rows only
+            return
+        async with self.session_factory() as session, session.begin():
+            paths = await archives_in_range(session, params.from_id, params.to_id)
+        for path in paths:
+            async for rows in iter_archive(path, self.fetch_rows):
+                yield [
+                    row
+                    for row in rows
+                    if (params.from_id is None or row[0] >= params.from_id)
+                    and (params.to_id is None or row[0] <= params.to_id)
+                ]
+
+    async def rows(self, params):
+        """Row tuples in key order, fetch_rows at a time."""
+        if params.name != "transactions":
+            async for rows in self._live_rows(params):
+                yield rows
+            return
+        # New ids can be credited into archived ranges, so the archived rows
+        # don't all come before the live ones
+        chunk = []
+        async for row in merge_sorted(
+            itemgetter(0),
+            _flatten(self._archived_rows(params)),
+            _flatten(self._live_rows(params)),
+        ):
+            chunk.append(row)
+            if len(chunk) >= self.fetch_rows:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+    async def _live_rows(self, params):
+        after_id = None if params.from_id is None else params.from_id - 1
+        while True:
+            count = 0
+            async with self.session_factory() as session, session.begin():
+                result = await session.stream(self._chunk_stmt(params, after_id))
+                async for rows in result.partitions():
+                    count += len(rows)
+                    after_id = rows[-1][0]
+                    yield rows
+            if count < self.chunk_rows:
+                return
+
+    async def stream(self, request, params):
+        async with self._slot():
+            headers = {
+                "Content-Disposition": f'attachment; filename="{params.filename}"'
+            }
+            content_type = CONTENT_TYPES[params.format]
+            if params.gzip:
+                content_type = "application/gzip"
+                compressor = zlib.compressobj(
+                    request.app.config.EXPORT_GZIP_LEVEL, zlib.DEFLATED, 31
+                )
+            loop = asyncio.get_running_loop()
+            response = await request.respond(content_type=content_type, headers=headers)
+
+            async def send(data):
+                if params.gzip:
+                    # zlib releases the GIL, the loop keeps serving requests
+                    data = await loop.run_in_executor(None, compressor.compress, data)
+                if data:
+                    await response.send(data)
+
+            keys = [column.key for column in EXPORTS[params.name][0]]
+            if params.format == "csv":
+                await send(encode_csv([keys]))
+            async for rows in self.rows(params):
+                if params.format == "csv":
+                    await send(encode_csv(rows))
+                else:
+                    await send(encode_ndjson(keys, rows))
+            if params.gzip:
+                await response.send(compressor.flush())
+            await response.eof()
+
+
+async def _flatten(chunks):
+    async for rows in chunks:
+        for row in rows:
+            yield row
+
+
+exporter = Exporter(
+    sessionmaker(
+        bind.execution_options(postgresql_readonly=True),
+        AsyncSession,
+        expire_on_commit=False,
+    ),
+    settings["EXPORT_CHUNK_ROWS"],
+    settings["STREAM_CHUNK_SIZE"],
+    settings["EXPORT_MAX_RUNNING"],
+)
@@ -0,0 +1,144 @@
+import asyncio
+import logging
+
+from sanic.exceptions import SanicException
+
+from db import apply_payment_batch, apply_payments_each
+
+logger = logging.getLogger(__name__)
+
+_STOP = object()
+
+
+class PaymentBuffer:
+    """
+    Write-behind queue for verified webhook payloads. One flusher task per
+    worker applies them in batches of up to max_batch, waiting at most
+    max_latency seconds for a batch to fill. submit() returns only after the
+    payload's batch is committed, so an acknowledged webhook is durable.
+    """
+
+    def __init__(self, session_factory, max_batch, max_latency, queue_size):
+        self.session_factory = session_factory
+        self.max_batch = max_batch
+        self.max_latency = max_latency
+        self.queue = asyncio.Queue(queue_size)
+        self.closed = False
+        self.batches = 0
+        self.items = 0
+
+    async def submit(self, json_dict):
+        """Returns "credited", "duplicate" or None on error."""
+        if self.closed:
+            raise SanicException("Server is shutting down.", status_code=503)
+        future = asyncio.get_running_loop().create_future()
+        try:
+            self.queue.put_nowait((json_dict, future))
+        except asyncio.QueueFull:
+            raise SanicException("Server is busy, try again later.", status_code=503)
+        return await future
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            item = await self.queue.get()
+            if item is _STOP:
+                return
+            batch = [item]
+            deadline = loop.time() + self.max_latency
+            stop = False
+            while len(batch) < self.max_batch:
+                try:
+                    item = self.queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    timeout = deadline - loop.time()
+                    if timeout <= 0:
+                        break
+                    try:
+                        item = await asyncio.wait_for(self.queue.get(), timeout)
+                    except asyncio.TimeoutError:
+                        break
+                if item is _STOP:
+                    stop = True
+                    break
+                batch.append(item)
+            await self.flush(batch)
+            if stop:
+                return
+
+    async def flush(self, batch):
+        payloads = [json_dict for json_dict, _ in batch]
+        try:
+            statuses = await self._apply(payloads)
+        except Exception:
+            logger.exception(
+                "Payment batch of %s failed, applying one by one", len(batch)
+            )
+            statuses = await self._apply_each(payloads)
+        self.batches += 1
+        self.items += len(batch)
+        for (_, future), status in zip(batch, statuses):
+            # The webhook request may have been cancelled meanwhile
+            if not future.done():
+                future.set_result(status)
+
+    async def _apply(self, payloads):
+        session = self.session_factory()
+        try:
+            async with session.begin():
+                return await apply_payment_batch(session, payloads)
+        finally:
+            await session.close()
+
+    async def _apply_each(self, payloads):
+        """One bad payload must not fail the rest of its batch."""
+        session = self.session_factory()
+        try:
+            async with session.begin():
+                statuses = await apply_payments_each(
+                    session, payloads, session.begin_nested
+                )
+        except Exception:
+            logger.exception("Payment batch commit failed")
+            statuses = [None] * len(payloads)
+        finally:
+            await session.close()
+        return statuses
+
+    async def close(self):
+        """Flushes what is queued, new payloads get 503."""
+        self.closed = True
+        await self.queue.put(_STOP)
+
+    def stats(self):
+        return {
+            "queued": self.queue.qsize(),
+            "batches": self.batches,
+            "items": self.items,
+        }
+
+
+def setup_payment_buffer(app, session_factory):
+    if not app.config.PAYMENT_BUFFER:
+        return
+
+    @app.before_server_start
+    async def create_payment_buffer(app, loop):
+        # Before the server accepts connections, so webhooks always find it
+        app.ctx.payment_buffer = PaymentBuffer(
+            session_factory,
+            app.config.PAYMENT_BUFFER_MAX_BATCH,
+            app.config.PAYMENT_BUFFER_MAX_LATENCY_MS / 1000,
+            app.config.PAYMENT_BUFFER_QUEUE,
+        )
+
+    @app.after_server_start
+    async def start_payment_buffer(app, loop):
+        app.ctx.payment_buffer_task = app.add_task(
+            app.ctx.payment_buffer.run(), name="payment_buffer"
+        )
+
+    @app.before_server_stop
+    async def drain_payment_buffer(app, loop):
+        await app.ctx.payment_buffer.close()
+        await app.ctx.payment_buffer_task
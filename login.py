@@ -1,9 +1,9 @@
-import jwt
 from sanic.exceptions import SanicException
 from sanic import Blueprint, text
 
-from db import get_user_by_username
-from utils import check_hashed_pass
+from db import get_user_by_username, update_user_password
+from auth import issue_token
+from passwords import password_hasher
 
 login = Blueprint("login", url_prefix="/login")
 
@@ -16,17 +16,32 @@ async def do_login(request):
         if username and password:
             user = await auth(request, username, password)
             if user:
-                token = jwt.encode({"user_id": user.id}, request.app.config.SECRET)
+                token = issue_token(
+                    user, request.app.config.SECRET, request.app.config.TOKEN_TTL
+                )
                 return text(token)
         raise SanicException("Username and password required.", status_code=500)
     raise SanicException("Empty json.", status_code=500)
 
 
 async def auth(request, username, password):
+    if not isinstance(username, str) or not isinstance(password, str):
+        # A JSON number, list or object, before it reaches the hasher
+        raise SanicException("Wrong username or password.", status_code=500)
     user = await get_user_by_username(request, username)
+    keys = (f"ip:{request.ip}", f"user:{username}")
     if user:
-        if check_hashed_pass(password, user.password):
-            if user.activated:
-                return user
-            raise SanicException("User not activated.", status_code=500)
+        valid, needs_rehash = await password_hasher.verify(
+            password, user.password, keys=keys
+        )
+    else:
+        # Hashed anyway, the response time must not tell which usernames exist
+        valid, needs_rehash = await password_hasher.verify_unknown(password, keys)
+    if valid:
+        if needs_rehash:
+            encoded = await password_hasher.hash(password)
+            await update_user_password(request, user.id, encoded)
+        if user.activated:
+            return user
+        raise SanicException("User not activated.", status_code=500)
     raise SanicException("Wrong username or password.", status_code=500)
@@ -0,0 +1,183 @@
+from contextvars import ContextVar
+from logging.handlers import QueueHandler, QueueListener
+
+import json
+import logging
+import queue
+import random
+import sys
+import time
+
+from sqlalchemy import event
+
+request_id_var = ContextVar("request_id", default=None)
+
+sql_logger = logging.getLogger("app.sql")
+
+# Loggers whose handlers are moved behind the queue
+QUEUED_LOGGERS = ("", "sanic.root", "sanic.error", "sanic.access")
+
+
+class RequestIdFilter(logging.Filter):
+    """Runs in the caller's thread, where the context var is set."""
+
+    def filter(self, record):
+        record.request_id = request_id_var.get()
+        return True
+
+
+class DeferredQueueHandler(QueueHandler):
+    """
+    Enqueues the record as is: message and traceback are formatted by the
+    listener thread instead of the event loop.
+    """
+
+    def prepare(self, record):
+        return record
+
+
+class JsonFormatter(logging.Formatter):
+    FIELDS = (
+        "request_id",
+        "duration_ms",
+        "statement",
+        "params",
+        # sanic.access extras
+        "host",
+        "request",
+        "status",
+        "byte",
+    )
+
+    def format(self, record):
+        data = {
+            "ts": round(record.created, 6),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        for field in self.FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                data[field] = value
+        if record.exc_info:
+            data["exc"] = self.formatException(record.exc_info)
+        return json.dumps(data, ensure_ascii=False, default=str)
+
+
+class RoutingQueueListener(QueueListener):
+    """Hands each record to the handlers its logger had before queuing."""
+
+    def __init__(self, queue, routes):
+        super().__init__(queue, respect_handler_level=True)
+        self.routes = routes
+
+    def handle(self, record):
+        handlers = self.routes.get(record.name, self.routes[""])
+        for handler in handlers:
+            if record.levelno >= handler.level:
+                handler.handle(record)
+
+
+class QueuedLogging:
+    """Moves the handlers of QUEUED_LOGGERS to one background writer thread."""
+
+    def __init__(self, config):
+        self.config = config
+        self.queue = queue.SimpleQueue()
+        self.listener = None
+        self._replaced = {}
+
+    def start(self):
+        if self.listener is not None:
+            return
+        handler = DeferredQueueHandler(self.queue)
+        handler.addFilter(RequestIdFilter())
+
+        routes = {}
+        for name in QUEUED_LOGGERS:
+            logger = logging.getLogger(name)
+            self._replaced[name] = (logger.handlers, logger.propagate)
+            routes[name] = logger.handlers
+            logger.handlers = [handler]
+            if name:
+                # Already queued here, the root handler would enqueue it twice
+                logger.propagate = False
+        if not routes[""]:
+            routes[""] = [logging.StreamHandler(sys.stdout)]
+
+        if self.config.LOG_JSON:
+            for handlers in routes.values():
+                for target in handlers:
+                    target.setFormatter(JsonFormatter())
+        logging.getLogger().setLevel(self.config.LOG_LEVEL)
+
+        self.listener = RoutingQueueListener(self.queue, routes)
+        self.listener.start()
+
+    def stop(self):
+        if self.listener is None:
+            return
+        self.listener.stop()
+        self.listener = None
+        for name, (handlers, propagate) in self._replaced.items():
+            logger = logging.getLogger(name)
+            logger.handlers = handlers
+            logger.propagate = propagate
+
+
+def setup_sql_logging(engine, config):
+    """
+    Replaces echo=True: statements slower than SLOW_QUERY_MS are always
+    logged, the rest with SQL_LOG_SAMPLE_RATE probability.
+    """
+    slow = config["SLOW_QUERY_MS"] / 1000
+    sample_rate = config["SQL_LOG_SAMPLE_RATE"]
+    with_params = config["LOG_SQL_PARAMS"]
+
+    @event.listens_for(engine.sync_engine, "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, statement, params, context, many):
+        conn.info.setdefault("log_query_started", []).append(time.perf_counter())
+
+    @event.listens_for(engine.sync_engine, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, params, context, many):
+        duration = time.perf_counter() - conn.info["log_query_started"].pop()
+        is_slow = duration >= slow
+        if is_slow or (sample_rate and random.random() < sample_rate):
+            sql_logger.log(
+                logging.WARNING if is_slow else logging.INFO,
+                "slow query" if is_slow else "query",
+                extra={
+                    "statement": statement,
+                    "params": params if with_params else None,
+                    "duration_ms": round(duration * 1000, 3),
+                },
+            )
+
+
+def setup_logging(app, engine, replica_engines=()):
+    queued_logging = QueuedLogging(app.config)
+    for each in (engine, *replica_engines):
+        setup_sql_logging(each, app.config)
+
+    @app.before_server_start
+    async def start_logging(app, loop):
+        queued_logging.start()
+
+    @app.after_server_stop
+    async def stop_logging(app, loop):
+        queued_logging.stop()
+
+    @app.middleware("request")
+    async def set_request_id(request):
+        request.ctx.request_id = str(request.id)
+        request.ctx.request_id_token = request_id_var.set(request.ctx.request_id)
+
+    @app.middleware("response")
+    async def reset_request_id(request, response):
+        if hasattr(request.ctx, "request_id"):
+            response.headers["X-Request-ID"] = request.ctx.request_id
+            try:
+                request_id_var.reset(request.ctx.request_id_token)
+            except ValueError:
+                pass
@@ -3,11 +3,33 @@ from sanic_openapi import openapi3_blueprint
 
 from routes import setup_routes
 from middlewares import setup_middlewares
+from metrics import setup_metrics
+from logs import setup_logging
+from auth import setup_auth
+from ledger import setup_payment_buffer
+from partitions import setup_partitions
+from replicas import setup_replicas
 from login import login
-from settings import settings, bind, async_session_factory
-from models import Base, User, Account, Product
+from settings import (
+    settings,
+    bind,
+    replica_binds,
+    async_session_factory,
+    engine_options,
+)
+from models import User, Account, Product
+from migrations import advisory_lock, migrate
+from passwords import hash_password
+from db import rebuild_user_totals
+
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.orm import sessionmaker
 
 import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
 
 app = Sanic(__name__)
 app.update_config(settings)
@@ -16,38 +38,134 @@ app.update_config(settings)
 app.blueprint(login)
 
 
-def setup_database(engine):
+def setup_database():
+    """
+    Applies pending migrations and seeds an empty database. Safe to run from
+    several processes at once, they take turns on an advisory lock.
+    """
+
     async def init_models():
-        async with engine.begin() as conn:
-            await conn.run_sync(Base.metadata.drop_all)
-            await conn.run_sync(Base.metadata.create_all)
-
-        session = async_session_factory()
-
-        user = User(
-            login="username",
-            password="password",
-            activated=True,
-            superuser=True,
-            accounts=[Account(balance=1000)],
+        # An engine of its own, bound to this loop: disposing the app's engine
+        # would recreate its pool with a thread lock around the first connect,
+        # which blocks the loop once the worker connects concurrently
+        engine = create_async_engine(
+            settings["DB_URL"], future=True, **engine_options(settings)
         )
+        try:
+            async with advisory_lock(engine):
+                await migrate(engine)
+                await seed_database(engine)
+        finally:
+            await engine.dispose()
 
-        product = Product(title="sometitle", description="somedesc", price=100)
+    asyncio.run(init_models())
 
-        async with session.begin():
-            session.add_all([user, product])
 
-    asyncio.run(init_models())
+async def seed_database(engine):
+    session = sessionmaker(engine, AsyncSession)()
+
+    async with session.begin():
+        result = await session.execute(select(User.id).limit(1))
+        if result.first() is None:
+            user = User(
+                login="username",
+                password=hash_password("password"),
+                activated=True,
+                superuser=True,
+                accounts=[Account(balance=1000)],
+            )
+            session.add(user)
+
+        result = await session.execute(select(Product.id).limit(1))
+        if result.first() is None:
+            product = Product(title="sometitle", description="somedesc", price=100)
+            session.add(product)
+
+        if session.new:
+            await session.flush()
+            await rebuild_user_totals(session)
+    await session.close()
+
+
+async def open_connections(engine, count):
+    # The first connect initializes the dialect, the rest wait for it
+    # rather than race it
+    first = await engine.connect()
+    results = [first] + await asyncio.gather(
+        *(engine.connect() for _ in range(count - 1)),
+        return_exceptions=True,
+    )
+    # Close the ones that opened even if others failed
+    for result in results:
+        if not isinstance(result, BaseException):
+            await result.close()
+    for result in results:
+        if isinstance(result, BaseException):
+            raise result
+
+
+def setup_listeners(app, engine, replica_engines=()):
+    @app.before_server_start
+    async def not_ready(app, loop):
+        app.ctx.ready = False
+
+    @app.after_server_start
+    async def warm_up_pool(app, loop):
+        """In the background, so the port opens at once and /health/ready gates."""
+        count = app.config.DB_POOL_WARMUP if app.config.DB_POOL else 0
+
+        async def warm_up():
+            delay = 0.5
+            while True:
+                try:
+                    await open_connections(engine, count)
+                except Exception:
+                    logger.exception("Database warm-up failed, retrying")
+                    await asyncio.sleep(delay)
+                    delay = min(delay * 2, 10)
+                else:
+                    app.ctx.ready = True
+                    return
+
+        async def warm_up_replica(replica_engine):
+            # Once and without gating readiness: until its first health
+            # check a replica gets no reads, and a failed one none at all
+            try:
+                await open_connections(replica_engine, count)
+            except Exception:
+                logger.exception("Replica warm-up failed")
+
+        app.add_task(warm_up(), name="warm_up_pool")
+        for index, replica_engine in enumerate(replica_engines):
+            app.add_task(
+                warm_up_replica(replica_engine), name=f"warm_up_replica_{index}"
+            )
+
+    @app.after_server_stop
+    async def dispose_pool(app, loop):
+        await engine.dispose()
+
+
+def setup_app(app):
+    """Everything a worker needs, shared with bench.py."""
+    setup_routes(app)
+    setup_logging(app, bind, replica_binds)
+    setup_metrics(app, bind, replica_binds)
+    replicas = setup_replicas(app, bind, replica_binds)
+    setup_middlewares(app, bind, replicas)
+    setup_listeners(app, bind, replica_binds)
+    setup_partitions(app, bind)
+    setup_auth(app)
+    setup_payment_buffer(app, async_session_factory)
 
 
 def init():
+    setup_app(app)
 
-    setup_routes(app)
-    setup_middlewares(app, bind)
-
-    setup_database(bind)
+    if app.config.MIGRATE_ON_START:
+        setup_database()
 
     app.run(
         debug=app.config.DEBUG,
-        workers=2,
+        workers=app.config.WORKERS,
     )
@@ -0,0 +1,181 @@
+from collections import defaultdict
+from contextvars import ContextVar
+
+import asyncio
+import glob
+import json
+import os
+import time
+
+from sanic.response import text
+from sqlalchemy import event
+
+_request_stats = ContextVar("request_stats", default=None)
+
+# Per worker totals by route, flushed to METRICS_DIR for /metrics
+COUNTERS = (
+    "requests",
+    "db_queries",
+    "db_seconds",
+    "handler_seconds",
+    "serialization_seconds",
+)
+GAUGES = ("db_queries_max",)
+
+
+def _route_totals():
+    return dict.fromkeys(COUNTERS + GAUGES, 0)
+
+
+_totals = defaultdict(_route_totals)
+
+
+class RequestStats:
+    __slots__ = ("started", "queries", "db_time", "serialization_time")
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.queries = 0
+        self.db_time = 0.0
+        self.serialization_time = 0.0
+
+
+def record_serialization(duration):
+    stats = _request_stats.get()
+    if stats is not None:
+        stats.serialization_time += duration
+
+
+def setup_engine_events(engine):
+    @event.listens_for(engine.sync_engine, "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, statement, params, context, many):
+        conn.info.setdefault("query_started", []).append(time.perf_counter())
+
+    @event.listens_for(engine.sync_engine, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, params, context, many):
+        started = conn.info["query_started"].pop()
+        stats = _request_stats.get()
+        if stats is not None:
+            stats.queries += 1
+            stats.db_time += time.perf_counter() - started
+
+
+def server_timing(stats, handler_time):
+    return (
+        f'db;dur={stats.db_time * 1000:.2f};desc="{stats.queries} queries", '
+        f"serialize;dur={stats.serialization_time * 1000:.2f}, "
+        f"app;dur={handler_time * 1000:.2f}"
+    )
+
+
+def _snapshot_path(directory):
+    return os.path.join(directory, f"worker-{os.getpid()}.json")
+
+
+def _write_snapshot(directory, data):
+    os.makedirs(directory, exist_ok=True)
+    path = _snapshot_path(directory)
+    with open(path + ".tmp", "w") as f:
+        f.write(data)
+    os.replace(path + ".tmp", path)
+
+
+async def flush_snapshot(directory):
+    # Serialised on the loop, the totals keep changing while the file is written
+    data = json.dumps(_totals)
+    loop = asyncio.get_running_loop()
+    await loop.run_in_executor(None, _write_snapshot, directory, data)
+
+
+def _read_snapshots(directory):
+    merged = defaultdict(_route_totals)
+    for path in glob.glob(os.path.join(directory, "worker-*.json")):
+        try:
+            with open(path) as f:
+                snapshot = json.load(f)
+        except (OSError, ValueError):
+            continue
+        for route, values in snapshot.items():
+            for name in COUNTERS:
+                merged[route][name] += values.get(name, 0)
+            merged[route]["db_queries_max"] = max(
+                merged[route]["db_queries_max"], values.get("db_queries_max", 0)
+            )
+    return merged
+
+
+def render_prometheus(totals):
+    lines = []
+    for name in COUNTERS + GAUGES:
+        kind = "gauge" if name in GAUGES else "counter"
+        suffix = "" if kind == "gauge" else "_total"
+        lines.append(f"# TYPE app_{name}{suffix} {kind}")
+        for route, values in sorted(totals.items()):
+            lines.append(f'app_{name}{suffix}{{route="{route}"}} {values[name]}')
+    return "\n".join(lines) + "\n"
+
+
+def setup_metrics(app, engine, replica_engines=()):
+    """
+    Must run before setup_middlewares, so the timing wraps the session
+    middlewares too.
+    """
+    directory = app.config.METRICS_DIR
+    for each in (engine, *replica_engines):
+        setup_engine_events(each)
+
+    @app.main_process_start
+    async def clear_snapshots(app, loop):
+        os.makedirs(directory, exist_ok=True)
+        for path in glob.glob(os.path.join(directory, "worker-*.json")):
+            os.remove(path)
+
+    @app.after_server_start
+    async def start_flusher(app, loop):
+        async def flush():
+            while True:
+                await asyncio.sleep(app.config.METRICS_FLUSH_INTERVAL)
+                await flush_snapshot(directory)
+
+        app.add_task(flush(), name="metrics_flush")
+
+    @app.before_server_stop
+    async def remove_snapshot(app, loop):
+        # Totals of a stopped worker are dropped, as with a restarted exporter
+        try:
+            os.remove(_snapshot_path(directory))
+        except OSError:
+            pass
+
+    @app.middleware("request")
+    async def start_request_stats(request):
+        request.ctx.stats = RequestStats()
+        request.ctx.stats_token = _request_stats.set(request.ctx.stats)
+
+    @app.middleware("response")
+    async def finish_request_stats(request, response):
+        stats = getattr(request.ctx, "stats", None)
+        if stats is None:
+            return
+        handler_time = time.perf_counter() - stats.started
+        response.headers["Server-Timing"] = server_timing(stats, handler_time)
+
+        route = request.route.path if request.route else "unmatched"
+        totals = _totals[route]
+        totals["requests"] += 1
+        totals["db_queries"] += stats.queries
+        totals["db_seconds"] += stats.db_time
+        totals["handler_seconds"] += handler_time
+        totals["serialization_seconds"] += stats.serialization_time
+        totals["db_queries_max"] = max(totals["db_queries_max"], stats.queries)
+        try:
+            _request_stats.reset(request.ctx.stats_token)
+        except ValueError:
+            pass
+
+    @app.get("/metrics")
+    async def metrics_endpoint(request):
+        await flush_snapshot(directory)
+        loop = asyncio.get_running_loop()
+        totals = await loop.run_in_executor(None, _read_snapshots, directory)
+        return text(render_prometheus(totals), content_type="text/plain; version=0.0.4")
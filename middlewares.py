@@ -1,21 +1,199 @@
+from contextlib import asynccontextmanager
 from contextvars import ContextVar
 
+import inspect
+import logging
+
+from sanic import text
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import sessionmaker
 
+logger = logging.getLogger(__name__)
 
-def setup_middlewares(app, bind):
-    _sessionmaker = sessionmaker(bind, AsyncSession, expire_on_commit=False)
+_base_model_session_ctx = ContextVar("session")
+
+READ_METHODS = ("GET", "HEAD", "OPTIONS")
+
+
+class LazySession:
+    """
+    Proxy that opens the AsyncSession on first attribute access.
+
+    In unit of work mode the request has one transaction: helpers join it via
+    transaction() and close_session commits or rolls it back.
+
+    route() returns a replica's session factory or None, it is awaited by the
+    first transaction(), so requests that never query don't pick a replica.
+    """
+
+    __slots__ = (
+        "_factory",
+        "_primary",
+        "_route",
+        "_session",
+        "_ctx_token",
+        "_after_commit",
+        "committed",
+        "unit_of_work",
+        "read_only",
+    )
+
+    def __init__(self, factory, unit_of_work=False, read_only=False, route=None):
+        self._factory = factory
+        self._primary = factory
+        self._route = route
+        self._session = None
+        self._ctx_token = None
+        self._after_commit = []
+        # Whether a transaction was committed, only those move the WAL
+        self.committed = False
+        self.unit_of_work = unit_of_work
+        self.read_only = read_only
+
+    @property
+    def started(self):
+        return self._session is not None
+
+    def __getattr__(self, name):
+        if self._session is None:
+            self._session = self._factory()
+            self._ctx_token = _base_model_session_ctx.set(self._session)
+        return getattr(self._session, name)
+
+    @asynccontextmanager
+    async def transaction(self, savepoint=False):
+        """
+        Use instead of session.begin(). savepoint=True for helpers that
+        handle their own errors, so a failure doesn't abort the whole request.
+        """
+        await self._apply_route()
+        if not self.unit_of_work:
+            async with self.begin():
+                yield
+            self.committed = True
+        elif savepoint:
+            async with self.begin_nested():
+                yield
+        else:
+            # Autobegin opens the request transaction on the first statement
+            yield
+
+    async def _apply_route(self):
+        if self._route is None:
+            return
+        route, self._route = self._route, None
+        if self._session is None:
+            factory = await route()
+            if factory is not None:
+                self._factory = factory
 
-    _base_model_session_ctx = ContextVar("session")
+    async def use_primary(self):
+        """
+        For reads that fill shared caches: data from a lagging replica would
+        stay cached after the write's invalidation.
+        """
+        self._route = None
+        if self._factory is not self._primary:
+            # Replica sessions are read-only, there is nothing to commit
+            await self.dispose()
+            self._factory = self._primary
+
+    async def after_commit(self, callback):
+        """Runs callback() once the data is committed, e.g. cache invalidation."""
+        if self.unit_of_work:
+            self._after_commit.append(callback)
+        else:
+            await _run_after_commit(callback)
+
+    async def finish(self, commit):
+        callbacks, self._after_commit = self._after_commit, []
+        if self._session is None:
+            return
+        try:
+            if self._session.in_transaction():
+                if commit and not self.read_only:
+                    await self._session.commit()
+                    self.committed = True
+                else:
+                    await self._session.rollback()
+                    callbacks = []
+        finally:
+            await self.dispose()
+        for callback in callbacks:
+            await _run_after_commit(callback)
+
+    async def dispose(self):
+        if self._session is None:
+            return
+        try:
+            await self._session.close()
+        finally:
+            self._session = None
+            try:
+                _base_model_session_ctx.reset(self._ctx_token)
+            except ValueError:
+                # Created in another context, e.g. a streaming task
+                pass
+
+
+async def _run_after_commit(callback):
+    # The data is committed already, a failed callback must not turn the
+    # response into an error
+    try:
+        result = callback()
+        if inspect.isawaitable(result):
+            await result
+    except Exception:
+        logger.exception("After commit callback %r failed", callback)
+
+
+def is_read_only(request):
+    """GET routes are read-only unless declared with ctx_writes=True."""
+    if request.method not in READ_METHODS:
+        return False
+    return not (request.route and getattr(request.route.ctx, "writes", False))
+
+
+def setup_middlewares(app, bind, replicas=None):
+    _sessionmaker = sessionmaker(bind, AsyncSession, expire_on_commit=False)
+    _readonly_sessionmaker = sessionmaker(
+        bind.execution_options(postgresql_readonly=True),
+        AsyncSession,
+        expire_on_commit=False,
+    )
+    unit_of_work = app.config.UNIT_OF_WORK
 
     @app.middleware("request")
     async def inject_session(request):
-        request.ctx.session = _sessionmaker()
-        request.ctx.session_ctx_token = _base_model_session_ctx.set(request.ctx.session)
+        read_only = is_read_only(request)
+        if unit_of_work and read_only:
+            factory = _readonly_sessionmaker
+        else:
+            factory = _sessionmaker
+        route = None
+        if read_only and replicas is not None:
+
+            async def route():
+                replica = await replicas.pick(request)
+                return replica.sessionmaker if replica is not None else None
+
+        request.ctx.session = LazySession(
+            factory,
+            unit_of_work=unit_of_work,
+            read_only=unit_of_work and read_only,
+            route=route,
+        )
 
     @app.middleware("response")
     async def close_session(request, response):
-        if hasattr(request.ctx, "session_ctx_token"):
-            _base_model_session_ctx.reset(request.ctx.session_ctx_token)
-            await request.ctx.session.close()
+        session = getattr(request.ctx, "session", None)
+        if session is None or not session.started:
+            return
+        try:
+            await session.finish(commit=response.status < 400)
+        except Exception:
+            logger.exception("Request transaction failed")
+            return text("Transaction failed.", status=500)
+        # Requests that committed nothing don't pay the WAL position round trip
+        if replicas is not None and session.committed and not is_read_only(request):
+            await replicas.remember_write(request)
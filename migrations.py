@@ -0,0 +1,298 @@
+"""
+
+Миграции схемы без drop_all.
+
+    python3 migrations.py           применить недостающие
+    python3 migrations.py --list    показать статус
+
+Каждая миграция применяется один раз и записывается в schema_migrations.
+Шаги написаны идемпотентно (IF NOT EXISTS или проверка каталога), поэтому на базе, созданной
+через create_all по текущим моделям, они ничего не меняют.
+
+"""
+from contextlib import asynccontextmanager
+from sqlalchemy import text
+
+import argparse
+import asyncio
+import logging
+
+from models import Base
+
+logger = logging.getLogger(__name__)
+
+# pg_advisory_lock key shared by every process that migrates or seeds
+LOCK_KEY = 4242001
+
+MIGRATIONS_TABLE = """
+CREATE TABLE IF NOT EXISTS schema_migrations (
+    version text PRIMARY KEY,
+    applied_at timestamptz NOT NULL DEFAULT now()
+)
+"""
+
+
+def create_tables(conn):
+    # Tables that don't exist yet, columns of existing ones are altered below
+    Base.metadata.create_all(conn, checkfirst=True)
+
+
+def create_index(name, statement, duplicates=None):
+    """
+    Step for CREATE INDEX CONCURRENTLY (without IF NOT EXISTS). A failed build
+    leaves an INVALID index, which is dropped and built again. duplicates is
+    a query for the values a unique index would reject, checked first.
+    """
+
+    async def step(conn):
+        result = await conn.execute(
+            text(
+                "SELECT indisvalid FROM pg_index WHERE indexrelid = to_regclass(:name)"
+            ),
+            {"name": name},
+        )
+        valid = result.scalar()
+        if valid:
+            return
+        if valid is not None:
+            logger.warning("Index %s is invalid, building it again", name)
+            await conn.execute(text(f"DROP INDEX CONCURRENTLY {name}"))
+        if duplicates:
+            result = await conn.execute(text(duplicates))
+            values = result.scalars().all()
+            if values:
+                raise RuntimeError(
+                    f"Can't create unique index {name}, duplicate values: "
+                    f"{', '.join(map(str, values))}. Remove them and migrate again."
+                )
+        await conn.execute(text(statement))
+
+    return step
+
+
+def create_unique_index(name, table, column):
+    return create_index(
+        name,
+        f"CREATE UNIQUE INDEX CONCURRENTLY {name} ON {table} ({column})",
+        duplicates=f"SELECT {column} FROM {table} WHERE {column} IS NOT NULL "
+        f"GROUP BY {column} HAVING count(*) > 1 LIMIT 10",
+    )
+
+
+async def backfill_user_totals(conn):
+    from db import rebuild_user_totals
+
+    await rebuild_user_totals(conn)
+
+
+async def backfill_archive_runs(conn):
+    from partitions import backfill_archive_runs
+
+    await backfill_archive_runs(conn)
+
+
+async def index_archives(conn):
+    from partitions import index_archives
+
+    await index_archives(conn)
+
+
+async def partition_transactions(conn):
+    from partitions import partition_table, ensure_partitions
+
+    await partition_table(conn)
+    await ensure_partitions(conn)
+
+
+# (version, steps, transactional). A step is SQL, a callable(sync_conn)
+# or a coroutine function(async_conn).
+# Index builds use CONCURRENTLY, which can't run inside a transaction.
+MIGRATIONS = [
+    ("0001_tables", [create_tables], True),
+    (
+        "0002_columns",
+        [
+            'ALTER TABLE "user" ADD COLUMN IF NOT EXISTS updated_at '
+            "timestamptz DEFAULT now()",
+            "ALTER TABLE product ADD COLUMN IF NOT EXISTS updated_at "
+            "timestamptz DEFAULT now()",
+            "ALTER TABLE account ADD COLUMN IF NOT EXISTS updated_at "
+            "timestamptz DEFAULT now()",
+            'ALTER TABLE "user" ADD COLUMN IF NOT EXISTS token_version '
+            "integer NOT NULL DEFAULT 0",
+        ],
+        True,
+    ),
+    (
+        "0003_indexes",
+        [
+            create_unique_index("ix_user_login", '"user"', "login"),
+            create_unique_index("ix_user_activate_link", '"user"', "activate_link"),
+            create_index(
+                "ix_account_user_id",
+                "CREATE INDEX CONCURRENTLY ix_account_user_id ON account (user_id)",
+            ),
+            # create_all makes it on a partitioned table, no CONCURRENTLY there
+            create_index(
+                "ix_transaction_bill_id_id",
+                "CREATE INDEX CONCURRENTLY ix_transaction_bill_id_id "
+                "ON transaction (bill_id, id)",
+            ),
+            create_index(
+                "ix_purchase_account_id",
+                "CREATE INDEX CONCURRENTLY ix_purchase_account_id "
+                "ON purchase (account_id)",
+            ),
+        ],
+        False,
+    ),
+    (
+        "0004_transaction_fk",
+        [
+            # NOT VALID takes no long lock, existing rows are checked separately
+            """
+            DO $$ BEGIN
+                IF NOT EXISTS (
+                    SELECT 1 FROM pg_constraint
+                    WHERE conname = 'transaction_bill_id_fkey'
+                ) THEN
+                    ALTER TABLE transaction ADD CONSTRAINT transaction_bill_id_fkey
+                    FOREIGN KEY (bill_id) REFERENCES account (id)
+                    DEFERRABLE INITIALLY DEFERRED NOT VALID;
+                END IF;
+            END $$
+            """,
+        ],
+        True,
+    ),
+    # Its own transaction: the lock taken by ADD CONSTRAINT is released before
+    # the scan, which holds only SHARE UPDATE EXCLUSIVE and lets writes through
+    (
+        "0004_transaction_fk_validate",
+        ["ALTER TABLE transaction VALIDATE CONSTRAINT transaction_bill_id_fkey"],
+        True,
+    ),
+    # The rebuild reads the transaction archive tables too
+    ("0005_user_totals", [create_tables, backfill_user_totals], True),
+    ("0006_transaction_partitions", [partition_transactions], True),
+    (
+        "0007_user_totals_version",
+        [
+            "ALTER TABLE user_totals ADD COLUMN IF NOT EXISTS version "
+            "bigint NOT NULL DEFAULT 1"
+        ],
+        True,
+    ),
+    (
+        "0008_transaction_archive_runs",
+        [create_tables, backfill_archive_runs],
+        True,
+    ),
+    (
+        "0009_transaction_archive_blocks",
+        [
+            create_tables,
+            "ALTER TABLE transaction_archive_bill ADD COLUMN IF NOT EXISTS blocks "
+            "integer[]",
+            index_archives,
+        ],
+        True,
+    ),
+    # Existing rows keep NULL, their credit time is unknown
+    (
+        "0010_transaction_created_at",
+        [
+            "ALTER TABLE transaction ADD COLUMN IF NOT EXISTS created_at timestamptz",
+            "ALTER TABLE transaction ALTER COLUMN created_at SET DEFAULT now()",
+        ],
+        True,
+    ),
+]
+
+
+async def run_step(conn, step):
+    if asyncio.iscoroutinefunction(step):
+        await step(conn)
+    elif callable(step):
+        await conn.run_sync(step)
+    else:
+        await conn.execute(text(step))
+
+
+async def applied_versions(engine):
+    async with engine.begin() as conn:
+        await conn.execute(text(MIGRATIONS_TABLE))
+        result = await conn.execute(text("SELECT version FROM schema_migrations"))
+        return set(result.scalars().all())
+
+
+@asynccontextmanager
+async def advisory_lock(engine, key=LOCK_KEY):
+    """
+    Session level lock on its own autocommit connection, so no transaction
+    stays open while CREATE INDEX CONCURRENTLY waits for older ones.
+    """
+    async with engine.connect() as conn:
+        conn = await conn.execution_options(isolation_level="AUTOCOMMIT")
+        await conn.execute(text("SELECT pg_advisory_lock(:key)"), {"key": key})
+        try:
+            yield
+        finally:
+            await conn.execute(text("SELECT pg_advisory_unlock(:key)"), {"key": key})
+
+
+async def migrate(engine):
+    """Applies pending migrations in order, returns their versions."""
+    applied = await applied_versions(engine)
+    done = []
+    for version, steps, transactional in MIGRATIONS:
+        if version in applied:
+            continue
+        logger.info("Applying migration %s", version)
+        if transactional:
+            async with engine.begin() as conn:
+                for step in steps:
+                    await run_step(conn, step)
+                await conn.execute(
+                    text("INSERT INTO schema_migrations (version) VALUES (:v)"),
+                    {"v": version},
+                )
+        else:
+            async with engine.connect() as conn:
+                conn = await conn.execution_options(isolation_level="AUTOCOMMIT")
+                for step in steps:
+                    await run_step(conn, step)
+                await conn.execute(
+                    text("INSERT INTO schema_migrations (version) VALUES (:v)"),
+                    {"v": version},
+                )
+        done.append(version)
+    return done
+
+
+def main():
+    from settings import bind
+
+    parser = argparse.ArgumentParser(description="Apply schema migrations.")
+    parser.add_argument("--list", action="store_true", help="show status only")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    async def run():
+        try:
+            if args.list:
+                applied = await applied_versions(bind)
+                for version, _, _ in MIGRATIONS:
+                    print(version, "applied" if version in applied else "pending")
+            else:
+                async with advisory_lock(bind):
+                    for version in await migrate(bind):
+                        print(version, "applied")
+        finally:
+            await bind.dispose()
+
+    asyncio.run(run())
+
+
+if __name__ == "__main__":
+    main()
@@ -3,21 +3,29 @@
 Пользователь – репрезентация пользователей в приложении. Должны быть обычные и админ пользователи (админ назначается руками в базе или создаётся на старте приложения)
 Товар – Состоит из заголовка, описания и цены
 Счёт – Имеет идентификатор счёта и баланс. Привязан к пользователю. У пользователя может быть несколько счетов
-Транзакция – история зачисления на счёт, хранит сумму зачисления и идентификатор счёта
+Транзакция – история зачисления на счёт, хранит сумму зачисления и идентификатор счёта.
+    Таблица секционирована по диапазонам id, холодные секции выгружаются в архив
+Покупка – списание со счёта за товар, хранит цену на момент покупки
+Итоги пользователя – суммы по счетам, зачислениям и покупкам, обновляются вместе с ними
 
 
 """
 from sqlalchemy import (
     INTEGER,
+    BigInteger,
     Column,
+    DateTime,
     Float,
     ForeignKey,
+    Index,
     Integer,
     LargeBinary,
     String,
     Boolean,
     Text,
+    func,
 )
+from sqlalchemy.dialects.postgresql import ARRAY
 from sqlalchemy.orm import declarative_base, relationship
 
 from utils import generate_uuid
@@ -31,8 +39,19 @@ class BaseModel(Base):
     id = Column(INTEGER(), primary_key=True)
 
 
-class User(BaseModel):
+class UpdatedAtMixin:
+    # Validator for ETag / Last-Modified, bumped by ORM and Core updates
+    updated_at = Column(
+        DateTime(timezone=True), server_default=func.now(), onupdate=func.now()
+    )
+
+
+class User(UpdatedAtMixin, BaseModel):
     __tablename__ = "user"
+    __table_args__ = (
+        Index("ix_user_login", "login", unique=True),
+        Index("ix_user_activate_link", "activate_link", unique=True),
+    )
 
     login = Column(String())
     password = Column(String())
@@ -40,6 +59,8 @@ class User(BaseModel):
     superuser = Column(Boolean(), default=False)
 
     activate_link = Column(String, default=generate_uuid)
+    # Tokens issued with an older version are rejected
+    token_version = Column(Integer(), default=0, server_default="0", nullable=False)
 
     accounts = relationship("Account")
 
@@ -47,7 +68,6 @@ class User(BaseModel):
         return {
             "id": self.id,
             "login": self.login,
-            "password": self.password,
             "activated": self.activated,
             "superuser": self.superuser,
             "accounts": [{"balance": acc.balance} for acc in self.accounts],
@@ -60,7 +80,7 @@ class User(BaseModel):
         return result
 
 
-class Product(BaseModel):
+class Product(UpdatedAtMixin, BaseModel):
     __tablename__ = "product"
 
     title = Column(String())
@@ -76,8 +96,9 @@ class Product(BaseModel):
         }
 
 
-class Account(BaseModel):
+class Account(UpdatedAtMixin, BaseModel):
     __tablename__ = "account"
+    __table_args__ = (Index("ix_account_user_id", "user_id"),)
 
     user_id = Column(ForeignKey("user.id"))
     user = relationship("User", back_populates="accounts")
@@ -93,9 +114,27 @@ class Account(BaseModel):
 
 class Transaction(BaseModel):
     __tablename__ = "transaction"
-
-    bill_id = Column(Integer())
+    __table_args__ = (
+        # Keyset history reads: WHERE bill_id IN (...) AND id > ? ORDER BY id
+        Index("ix_transaction_bill_id_id", "bill_id", "id"),
+        # Partitions are created by partitions.py, id > ? prunes the older ones
+        {"postgresql_partition_by": "RANGE (id)"},
+    )
+
+    # Assigned by the payment provider
+    id = Column(INTEGER(), primary_key=True, autoincrement=False)
+    # Deferred, a webhook batch inserts transactions before creating the account
+    bill_id = Column(
+        ForeignKey(
+            "account.id",
+            name="transaction_bill_id_fkey",
+            deferrable=True,
+            initially="DEFERRED",
+        )
+    )
     amount = Column(Float())
+    # NULL for the rows credited before it was recorded
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
 
     def to_dict(self):
         return {
@@ -103,3 +142,97 @@ class Transaction(BaseModel):
             "bill_id": self.bill_id,
             "amount": self.amount,
         }
+
+
+class Purchase(BaseModel):
+    __tablename__ = "purchase"
+    __table_args__ = (Index("ix_purchase_account_id", "account_id"),)
+
+    account_id = Column(ForeignKey("account.id"))
+    product_id = Column(ForeignKey("product.id", ondelete="SET NULL"))
+    price = Column(Float())
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "account_id": self.account_id,
+            "product_id": self.product_id,
+            "price": self.price,
+        }
+
+
+class TransactionArchive(Base):
+    """A transaction partition exported to a CSV.gz file and truncated."""
+
+    __tablename__ = "transaction_archive"
+
+    name = Column(String(), primary_key=True)
+    lower = Column(Integer(), nullable=True)  # None for MINVALUE
+    upper = Column(Integer(), nullable=False)
+    path = Column(String(), nullable=False)
+    rows = Column(Integer(), nullable=False)
+    archived_at = Column(DateTime(timezone=True), server_default=func.now())
+
+
+class TransactionArchiveBill(Base):
+    """Per bill totals of an archive, history reads only open files it lists."""
+
+    __tablename__ = "transaction_archive_bill"
+
+    bill_id = Column(Integer(), primary_key=True)
+    archive = Column(ForeignKey("transaction_archive.name"), primary_key=True)
+    count = Column(Integer(), nullable=False)
+    amount = Column(Float(), nullable=False)
+    # TransactionArchiveBlock numbers holding the bill's rows
+    blocks = Column(ARRAY(Integer()))
+
+
+class TransactionArchiveBlock(Base):
+    """A gzip member of an archive file, read on its own by history pages."""
+
+    __tablename__ = "transaction_archive_block"
+
+    archive = Column(ForeignKey("transaction_archive.name"), primary_key=True)
+    number = Column(Integer(), primary_key=True)
+    offset = Column(BigInteger(), nullable=False)
+    length = Column(Integer(), nullable=False)
+    first_id = Column(Integer(), nullable=False)
+    last_id = Column(Integer(), nullable=False)
+
+
+class TransactionArchiveRun(Base):
+    """Consecutive archived ids, a payment replaying one of them is a duplicate."""
+
+    __tablename__ = "transaction_archive_run"
+    __table_args__ = (Index("ix_transaction_archive_run_last_id", "last_id"),)
+
+    first_id = Column(Integer(), primary_key=True)
+    last_id = Column(Integer(), nullable=False)
+    archive = Column(ForeignKey("transaction_archive.name"), nullable=False)
+
+
+class UserTotals(Base):
+    """Maintained in the same transaction as payments and purchases."""
+
+    __tablename__ = "user_totals"
+
+    user_id = Column(ForeignKey("user.id"), primary_key=True)
+    balance = Column(Float(), default=0, server_default="0", nullable=False)
+    transactions_count = Column(
+        Integer(), default=0, server_default="0", nullable=False
+    )
+    transactions_amount = Column(Float(), default=0, server_default="0", nullable=False)
+    purchases_count = Column(Integer(), default=0, server_default="0", nullable=False)
+    purchases_amount = Column(Float(), default=0, server_default="0", nullable=False)
+    # Bumped by every write to the user, its accounts or totals, under the
+    # row lock, so unlike updated_at it only grows in commit order
+    version = Column(BigInteger(), default=1, server_default="1", nullable=False)
+
+    def to_dict(self):
+        return {
+            "balance": self.balance,
+            "transactions_count": self.transactions_count,
+            "transactions_amount": self.transactions_amount,
+            "purchases_count": self.purchases_count,
+            "purchases_amount": self.purchases_amount,
+        }
@@ -0,0 +1,660 @@
+"""
+
+Секции таблицы transaction и архив.
+
+    python3 partitions.py              создать недостающие секции
+    python3 partitions.py --list       показать секции и архивы
+    python3 partitions.py --archive    выгрузить холодные секции в архив
+
+Таблица секционирована по диапазонам id по TRANSACTION_PARTITION_SIZE.
+Секции создаются заранее на TRANSACTION_PARTITIONS_AHEAD диапазонов вперёд,
+строки за последней секцией попадают в transaction_default и переносятся
+при создании следующей секции.
+
+Архивация оставляет TRANSACTION_ARCHIVE_KEEP последних секций с данными,
+остальные выгружаются в TRANSACTION_ARCHIVE_DIR как CSV.gz (отсортированы
+по id) и очищаются. Диапазоны архивных id записываются в
+transaction_archive_run: платёж с таким id возвращает "duplicate", а новый
+id из архивного диапазона зачисляется в опустевшую секцию.
+
+Файл архива состоит из отдельных gzip-блоков по TRANSACTION_ARCHIVE_BLOCK_ROWS
+строк, их смещения и диапазоны id записаны в transaction_archive_block, а
+номера блоков каждого счёта - в transaction_archive_bill. История
+пользователя распаковывает только блоки со своими счетами после after_id и
+по одному, пока не наберёт limit строк.
+
+"""
+from sqlalchemy import (
+    any_,
+    bindparam,
+    exists,
+    func,
+    insert,
+    select,
+    text,
+    update,
+)
+
+import argparse
+import asyncio
+import bisect
+import csv
+import gzip
+import io
+import itertools
+import logging
+import os
+import re
+
+from models import (
+    Account,
+    Transaction,
+    TransactionArchive,
+    TransactionArchiveBill,
+    TransactionArchiveBlock,
+    TransactionArchiveRun,
+)
+from settings import settings
+
+logger = logging.getLogger(__name__)
+
+# pg_advisory_xact_lock key of partition maintenance
+LOCK_KEY = 4242002
+# Two-key pg_advisory_xact_lock of id ranges, by TRANSACTION_PARTITION_SIZE:
+# exclusive while one is archived, shared by payments inserting into it
+ARCHIVE_LOCK_KEY = 4242003
+
+TABLE = Transaction.__tablename__
+DEFAULT_PARTITION = f"{TABLE}_default"
+COLUMNS = ("id", "bill_id", "amount")
+
+_BOUND = re.compile(r"FROM \((\w+)\) TO \((\w+)\)")
+
+
+def partition_name(lower):
+    return f"{TABLE}_p{lower}"
+
+
+def _bound(value):
+    return None if value == "MINVALUE" else int(value)
+
+
+def _bound_sql(value):
+    return "MINVALUE" if value is None else str(int(value))
+
+
+async def list_partitions(conn):
+    """[(name, lower, upper)] ordered by range, lower is None for MINVALUE."""
+    result = await conn.execute(
+        text(
+            "SELECT c.relname, pg_get_expr(c.relpartbound, c.oid) "
+            "FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid "
+            "WHERE i.inhparent = CAST(:table AS regclass)"
+        ),
+        {"table": TABLE},
+    )
+    partitions = []
+    for name, bound in result:
+        match = _BOUND.search(bound)
+        if match:
+            lower, upper = match.groups()
+            partitions.append((name, _bound(lower), _bound(upper)))
+    partitions.sort(key=lambda p: p[2])
+    return partitions
+
+
+async def is_partitioned(conn):
+    # Compared in SQL: asyncpg returns the "char" relkind as bytes
+    result = await conn.execute(
+        text(
+            "SELECT relkind = 'p' FROM pg_class " "WHERE oid = CAST(:table AS regclass)"
+        ),
+        {"table": TABLE},
+    )
+    return bool(result.scalar())
+
+
+async def partition_table(conn, size=None):
+    """
+    Turns the plain transaction table into the first partition of a new
+    partitioned one, so existing rows are not copied. Attaching scans it once
+    under the lock taken by the rename.
+    """
+    if await is_partitioned(conn):
+        return
+    size = size or settings["TRANSACTION_PARTITION_SIZE"]
+    legacy = partition_name(0)
+    for statement in (
+        f"ALTER TABLE {TABLE} RENAME TO {legacy}",
+        f"ALTER TABLE {legacy} RENAME CONSTRAINT {TABLE}_pkey TO {legacy}_pkey",
+        f"ALTER INDEX ix_{TABLE}_bill_id_id RENAME TO ix_{legacy}_bill_id_id",
+        f"ALTER TABLE {legacy} ALTER COLUMN id DROP DEFAULT",
+        # Columns added after 0006 are created with the partitioned table
+        f"ALTER TABLE {legacy} ADD COLUMN IF NOT EXISTS created_at timestamptz",
+    ):
+        await conn.execute(text(statement))
+    max_id = (await conn.execute(text(f"SELECT max(id) FROM {legacy}"))).scalar()
+    upper = ((max_id or 0) // size + 1) * size
+
+    await conn.run_sync(
+        lambda sync_conn: Transaction.__table__.create(sync_conn, checkfirst=False)
+    )
+    await conn.execute(
+        text(
+            f"ALTER TABLE {TABLE} ATTACH PARTITION {legacy} "
+            f"FOR VALUES FROM (MINVALUE) TO ({upper})"
+        )
+    )
+
+
+async def _create_partition(conn, lower, upper):
+    # Rows that went to the default partition move with the range
+    name = partition_name(lower)
+    await conn.execute(text(f"CREATE TABLE {name} (LIKE {TABLE} INCLUDING DEFAULTS)"))
+    # Until the attach commits, a payment landing in the default partition
+    # would make the attach fail
+    await conn.execute(
+        text(f"LOCK TABLE {DEFAULT_PARTITION} IN SHARE ROW EXCLUSIVE MODE")
+    )
+    await conn.execute(
+        text(
+            f"WITH moved AS (DELETE FROM {DEFAULT_PARTITION} "
+            f"WHERE id >= {lower} AND id < {upper} RETURNING *) "
+            f"INSERT INTO {name} SELECT * FROM moved"
+        )
+    )
+    await conn.execute(
+        text(
+            f"ALTER TABLE {TABLE} ATTACH PARTITION {name} "
+            f"FOR VALUES FROM ({lower}) TO ({upper})"
+        )
+    )
+    logger.info("Created partition %s [%s, %s)", name, lower, upper)
+    return name
+
+
+async def ensure_partitions(conn, size=None, ahead=None):
+    """
+    Creates partitions up to `ahead` ranges past the range of the highest id,
+    nothing when they exist already.
+    """
+    size = size or settings["TRANSACTION_PARTITION_SIZE"]
+    ahead = settings["TRANSACTION_PARTITIONS_AHEAD"] if ahead is None else ahead
+    await conn.execute(
+        text(
+            f"CREATE TABLE IF NOT EXISTS {DEFAULT_PARTITION} "
+            f"PARTITION OF {TABLE} DEFAULT"
+        )
+    )
+    partitions = await list_partitions(conn)
+    result = await conn.execute(text(f"SELECT min(id), max(id) FROM {TABLE}"))
+    min_id, max_id = result.first()
+    if partitions:
+        top = partitions[-1][2]
+    else:
+        top = (min_id or 0) // size * size
+    # From max_id only: counting from the top partition would add one each run
+    target = ((max_id or 0) // size + 1 + ahead) * size
+    if top >= target:
+        return []
+
+    created = []
+    while top < target:
+        created.append(await _create_partition(conn, top, top + size))
+        top += size
+    return created
+
+
+async def maintain_partitions(engine):
+    """Safe to call from every worker, one of them does the work at a time."""
+    async with engine.begin() as conn:
+        result = await conn.execute(
+            text("SELECT pg_try_advisory_xact_lock(:key)"), {"key": LOCK_KEY}
+        )
+        if result.scalar():
+            return await ensure_partitions(conn)
+    return []
+
+
+def setup_partitions(app, engine):
+    @app.after_server_start
+    async def start_partition_maintenance(app, loop):
+        async def maintain():
+            while True:
+                try:
+                    await maintain_partitions(engine)
+                except Exception:
+                    logger.exception("Partition maintenance failed")
+                await asyncio.sleep(app.config.TRANSACTION_PARTITION_CHECK_INTERVAL)
+
+        app.add_task(maintain(), name="partition_maintenance")
+
+
+# Archive
+
+
+def _write_rows(file, rows):
+    writer = csv.writer(file)
+    for row in rows:
+        writer.writerow(("" if value is None else value for value in row))
+
+
+def _add_runs(runs, ids):
+    """Extends runs, [first_id, last_id] lists, with ascending ids."""
+    for trx_id in ids:
+        if runs and runs[-1][1] == trx_id - 1:
+            runs[-1][1] = trx_id
+        else:
+            runs.append([trx_id, trx_id])
+
+
+async def _insert_runs(conn, name, runs):
+    if runs:
+        await conn.execute(
+            insert(TransactionArchiveRun),
+            [
+                {"archive": name, "first_id": first, "last_id": last}
+                for first, last in runs
+            ],
+        )
+
+
+def _lock_bucket(trx_id, size):
+    # Negative ids are possible below MINVALUE bounds, they share bucket 0
+    return max(trx_id, 0) // size
+
+
+async def lock_archived_ranges(conn, ids, size=None):
+    """
+    Taken by payments before archived_ids() and their insert. An archive
+    of the range commits its runs before the lock is granted, so the lookup,
+    a later statement of the transaction, sees them.
+    """
+    size = size or settings["TRANSACTION_PARTITION_SIZE"]
+    # Ascending, as archive_partition takes them
+    for bucket in sorted({_lock_bucket(trx_id, size) for trx_id in ids}):
+        await conn.execute(
+            text("SELECT pg_advisory_xact_lock_shared(:key, :bucket)"),
+            {"key": ARCHIVE_LOCK_KEY, "bucket": bucket},
+        )
+
+
+async def archived_ids(conn, ids):
+    """The ids among `ids` that are in an archive."""
+    if not ids:
+        return set()
+    result = await conn.execute(
+        select(TransactionArchiveRun.first_id, TransactionArchiveRun.last_id)
+        .where(
+            TransactionArchiveRun.last_id >= min(ids),
+            TransactionArchiveRun.first_id <= max(ids),
+        )
+        .order_by(TransactionArchiveRun.first_id)
+    )
+    runs = result.all()
+    firsts = [first for first, _ in runs]
+    archived = set()
+    for trx_id in ids:
+        index = bisect.bisect_right(firsts, trx_id) - 1
+        if index >= 0 and runs[index][1] >= trx_id:
+            archived.add(trx_id)
+    return archived
+
+
+def is_archived(trx_id):
+    """SQL condition of archived_ids() for one id, for a single statement."""
+    last_id = (
+        select(TransactionArchiveRun.last_id)
+        .where(TransactionArchiveRun.first_id <= trx_id)
+        .order_by(TransactionArchiveRun.first_id.desc())
+        .limit(1)
+        .scalar_subquery()
+    )
+    return func.coalesce(last_id >= trx_id, False)
+
+
+class ArchiveWriter:
+    """
+    Rows sorted by id as a header and blocks of rows, each its own gzip
+    member: gzip readers see one CSV file, and a block can be decompressed
+    alone from its offset. Collects the per bill totals, the block index and
+    the id runs on the way.
+    """
+
+    def __init__(self, file):
+        self.file = file
+        self.offset = 0
+        self.rows = 0
+        self.blocks = []  # (number, offset, length, first_id, last_id)
+        self.bills = {}  # bill_id: [count, amount, block numbers]
+        self.runs = []
+        self._member([COLUMNS])
+
+    def _member(self, rows):
+        buffer = io.StringIO(newline="")
+        _write_rows(buffer, rows)
+        data = gzip.compress(buffer.getvalue().encode())
+        self.file.write(data)
+        self.offset += len(data)
+        return len(data)
+
+    def write(self, rows):
+        """One block of rows, ascending and after the previous blocks."""
+        number = len(self.blocks)
+        offset = self.offset
+        length = self._member(rows)
+        self.blocks.append((number, offset, length, rows[0][0], rows[-1][0]))
+        _add_runs(self.runs, (row[0] for row in rows))
+        for _, bill_id, amount in rows:
+            if bill_id is None:
+                continue
+            bill = self.bills.setdefault(bill_id, [0, 0.0, set()])
+            bill[0] += 1
+            bill[1] += amount or 0
+            bill[2].add(number)
+        self.rows += len(rows)
+
+
+async def _write_archive(path, chunks):
+    """ArchiveWriter file at path from async chunks of rows, replaced at once."""
+    loop = asyncio.get_running_loop()
+    with open(path + ".tmp", "wb") as raw:
+        writer = ArchiveWriter(raw)
+        async for rows in chunks:
+            # zlib releases the GIL
+            await loop.run_in_executor(None, writer.write, rows)
+        raw.flush()
+        os.fsync(raw.fileno())
+    os.replace(path + ".tmp", path)
+    return writer
+
+
+async def _insert_blocks(conn, name, writer):
+    if writer.blocks:
+        await conn.execute(
+            insert(TransactionArchiveBlock),
+            [
+                {
+                    "archive": name,
+                    "number": number,
+                    "offset": offset,
+                    "length": length,
+                    "first_id": first_id,
+                    "last_id": last_id,
+                }
+                for number, offset, length, first_id, last_id in writer.blocks
+            ],
+        )
+
+
+async def archive_partition(conn, name, lower, upper, directory):
+    """
+    Exports one partition ordered by id and truncates it, in the caller's
+    transaction. A file left by a failed commit is overwritten on the next run.
+    """
+    size = settings["TRANSACTION_PARTITION_SIZE"]
+    first = _lock_bucket(lower or 0, size)
+    for bucket in range(first, _lock_bucket(upper - 1, size) + 1):
+        await conn.execute(
+            text("SELECT pg_advisory_xact_lock(:key, :bucket)"),
+            {"key": ARCHIVE_LOCK_KEY, "bucket": bucket},
+        )
+    await conn.execute(text(f"LOCK TABLE {name} IN SHARE MODE"))
+    path = os.path.join(directory, f"{name}.csv.gz")
+    block_rows = settings["TRANSACTION_ARCHIVE_BLOCK_ROWS"]
+    try:
+        result = await conn.stream(
+            text(f"SELECT id, bill_id, amount FROM {name} ORDER BY id"),
+            execution_options={"yield_per": block_rows},
+        )
+        writer = await _write_archive(path, result.partitions(block_rows))
+
+        await conn.execute(
+            TransactionArchive.__table__.insert().values(
+                name=name, lower=lower, upper=upper, path=path, rows=writer.rows
+            )
+        )
+        await _insert_blocks(conn, name, writer)
+        if writer.bills:
+            await conn.execute(
+                insert(TransactionArchiveBill),
+                [
+                    {
+                        "bill_id": bill_id,
+                        "archive": name,
+                        "count": count,
+                        "amount": amount,
+                        "blocks": sorted(blocks),
+                    }
+                    for bill_id, (count, amount, blocks) in writer.bills.items()
+                ],
+            )
+        await _insert_runs(conn, name, writer.runs)
+        await conn.execute(text(f"TRUNCATE {name}"))
+    except BaseException:
+        for leftover in (path, path + ".tmp"):
+            if os.path.exists(leftover):
+                os.remove(leftover)
+        raise
+    logger.info("Archived %s, %s rows to %s", name, writer.rows, path)
+    return path, writer.rows
+
+
+async def archive_partitions(engine, keep=None, directory=None):
+    """Archives every partition but the `keep` newest ones holding data."""
+    keep = settings["TRANSACTION_ARCHIVE_KEEP"] if keep is None else keep
+    directory = directory or settings["TRANSACTION_ARCHIVE_DIR"]
+    os.makedirs(directory, exist_ok=True)
+
+    async with engine.begin() as conn:
+        partitions = await list_partitions(conn)
+        result = await conn.execute(select(TransactionArchive.name))
+        archived = set(result.scalars().all())
+        max_id = (await conn.execute(text(f"SELECT max(id) FROM {TABLE}"))).scalar()
+    if max_id is None:
+        return []
+
+    filled = [p for p in partitions if p[1] is None or p[1] <= max_id]
+    cold = filled[: max(len(filled) - keep, 0)]
+    done = []
+    for name, lower, upper in cold:
+        if name in archived:
+            continue
+        # One transaction per partition, a failure keeps the earlier ones
+        async with engine.begin() as conn:
+            await archive_partition(conn, name, lower, upper, directory)
+        done.append(name)
+    return done
+
+
+async def backfill_archive_runs(conn):
+    """
+    Runs of the archives made before they were recorded, which were closed
+    with CHECK (false) instead.
+    """
+    result = await conn.execute(
+        select(TransactionArchive.name, TransactionArchive.path).where(
+            ~exists().where(TransactionArchiveRun.archive == TransactionArchive.name)
+        )
+    )
+    for name, path in result.all():
+        runs = []
+        async for rows in iter_archive(path, settings["STREAM_CHUNK_SIZE"]):
+            _add_runs(runs, (row[0] for row in rows))
+        await _insert_runs(conn, name, runs)
+        await conn.execute(
+            text(
+                f"ALTER TABLE IF EXISTS {name} DROP CONSTRAINT IF EXISTS {name}_archived"
+            )
+        )
+        logger.info("Recorded %s id runs of archive %s", len(runs), name)
+
+
+async def index_archives(conn):
+    """
+    Rewrites the archives made before the block format, a single gzip
+    stream, into blocks and records their index.
+    """
+    result = await conn.execute(
+        select(TransactionArchive.name, TransactionArchive.path).where(
+            ~exists().where(TransactionArchiveBlock.archive == TransactionArchive.name)
+        )
+    )
+    block_rows = settings["TRANSACTION_ARCHIVE_BLOCK_ROWS"]
+    for name, path in result.all():
+        writer = await _write_archive(path, iter_archive(path, block_rows))
+        await _insert_blocks(conn, name, writer)
+        if writer.bills:
+            await conn.execute(
+                update(TransactionArchiveBill)
+                .where(
+                    TransactionArchiveBill.archive == name,
+                    TransactionArchiveBill.bill_id == bindparam("bill"),
+                )
+                .values(blocks=bindparam("bill_blocks")),
+                [
+                    {"bill": bill_id, "bill_blocks": sorted(blocks)}
+                    for bill_id, (_, _, blocks) in writer.bills.items()
+                ],
+            )
+        logger.info("Indexed %s blocks of archive %s", len(writer.blocks), name)
+
+
+async def archived_blocks(session, user_id, after_id=0):
+    """
+    [(path, offset, length, bill_ids)] of the blocks holding the user's
+    archived rows with id > after_id, in id order. Only the index is read.
+    """
+    stmt = (
+        select(
+            TransactionArchive.path,
+            TransactionArchiveBlock.offset,
+            TransactionArchiveBlock.length,
+            func.array_agg(TransactionArchiveBill.bill_id),
+        )
+        .join(
+            TransactionArchiveBlock,
+            TransactionArchiveBlock.archive == TransactionArchive.name,
+        )
+        .join(
+            TransactionArchiveBill,
+            (TransactionArchiveBill.archive == TransactionArchive.name)
+            & (TransactionArchiveBlock.number == any_(TransactionArchiveBill.blocks)),
+        )
+        .join(Account, Account.id == TransactionArchiveBill.bill_id)
+        .where(Account.user_id == user_id, TransactionArchiveBlock.last_id > after_id)
+        .group_by(
+            TransactionArchive.path,
+            TransactionArchiveBlock.archive,
+            TransactionArchiveBlock.number,
+        )
+        .order_by(TransactionArchiveBlock.first_id)
+    )
+    result = await session.execute(stmt)
+    return result.all()
+
+
+def _read_block(path, offset, length):
+    with open(path, "rb") as file:
+        file.seek(offset)
+        data = gzip.decompress(file.read(length))
+    reader = csv.reader(io.StringIO(data.decode(), newline=""))
+    return [_parse_row(row) for row in reader]
+
+
+async def read_archived_blocks(blocks, after_id=0):
+    """Rows of archived_blocks() as dicts, one block decompressed at a time."""
+    loop = asyncio.get_running_loop()
+    for path, offset, length, bill_ids in blocks:
+        rows = await loop.run_in_executor(None, _read_block, path, offset, length)
+        bill_ids = set(bill_ids)
+        for trx_id, bill_id, amount in rows:
+            if trx_id > after_id and bill_id in bill_ids:
+                yield {"id": trx_id, "bill_id": bill_id, "amount": amount}
+
+
+async def read_archived_transactions(session, user_id, after_id=0, limit=None):
+    """
+    The user's archived rows with id > after_id, in id order. Stops
+    decompressing blocks once limit rows are read.
+    """
+    blocks = await archived_blocks(session, user_id, after_id)
+    rows = []
+    if limit is not None and limit <= 0:
+        return rows
+    async for row in read_archived_blocks(blocks, after_id):
+        rows.append(row)
+        if limit is not None and len(rows) >= limit:
+            break
+    return rows
+
+
+def _parse_row(row):
+    trx_id, bill_id, amount = row
+    return int(trx_id), int(bill_id) if bill_id else None, float(amount)
+
+
+def _read_chunk(reader, size):
+    return [_parse_row(row) for row in itertools.islice(reader, size)]
+
+
+async def iter_archive(path, chunk_size):
+    """(id, bill_id, amount) rows of one archive file, chunk_size at a time."""
+    loop = asyncio.get_running_loop()
+    with gzip.open(path, "rt", newline="") as file:
+        reader = csv.reader(file)
+        await loop.run_in_executor(None, next, reader)
+        while True:
+            rows = await loop.run_in_executor(None, _read_chunk, reader, chunk_size)
+            if not rows:
+                return
+            yield rows
+
+
+async def archives_in_range(session, from_id=None, to_id=None):
+    """Paths of the archives overlapping [from_id, to_id], in id order."""
+    stmt = select(TransactionArchive.path).order_by(TransactionArchive.upper)
+    if from_id is not None:
+        stmt = stmt.where(TransactionArchive.upper > from_id)
+    if to_id is not None:
+        stmt = stmt.where(
+            (TransactionArchive.lower.is_(None)) | (TransactionArchive.lower <= to_id)
+        )
+    result = await session.execute(stmt)
+    return result.scalars().all()
+
+
+def main():
+    from settings import bind
+
+    parser = argparse.ArgumentParser(description="Transaction partitions.")
+    parser.add_argument("--list", action="store_true", help="show partitions")
+    parser.add_argument("--archive", action="store_true", help="archive cold ones")
+    parser.add_argument("--keep", type=int, help="partitions with data kept live")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    async def run():
+        try:
+            if args.list:
+                async with bind.connect() as conn:
+                    result = await conn.execute(select(TransactionArchive.name))
+                    archived = set(result.scalars().all())
+                    for name, lower, upper in await list_partitions(conn):
+                        status = "archived" if name in archived else "live"
+                        print(name, _bound_sql(lower), upper, status)
+            elif args.archive:
+                for name in await archive_partitions(bind, keep=args.keep):
+                    print(name, "archived")
+            else:
+                async with bind.begin() as conn:
+                    for name in await ensure_partitions(conn):
+                        print(name, "created")
+        finally:
+            await bind.dispose()
+
+    asyncio.run(run())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from collections import defaultdict
+
+import asyncio
+import base64
+import hashlib
+import hmac
+import os
+
+from sanic.exceptions import SanicException
+
+from settings import settings
+
+PREFIX = "scrypt"
+
+
+def _b64(data):
+    return base64.b64encode(data).decode()
+
+
+def hash_password(password, n=None, r=None, p=None):
+    """scrypt$n$r$p$salt$hash, CPU bound, call through PasswordHasher on the loop."""
+    n = n or settings["SCRYPT_N"]
+    r = r or settings["SCRYPT_R"]
+    p = p or settings["SCRYPT_P"]
+    salt = os.urandom(16)
+    key = hashlib.scrypt(
+        password.encode(), salt=salt, n=n, r=r, p=p, maxmem=256 * n * r * p
+    )
+    return f"{PREFIX}${n}${r}${p}${_b64(salt)}${_b64(key)}"
+
+
+def verify_password(password, encoded):
+    """Returns (valid, needs_rehash)."""
+    if not encoded or not isinstance(password, str):
+        return False, False
+    parts = encoded.split("$")
+    if len(parts) != 6 or parts[0] != PREFIX:
+        # Stored before hashing existed, upgraded on the next login
+        return hmac.compare_digest(password.encode(), encoded.encode()), True
+    n, r, p = (int(value) for value in parts[1:4])
+    salt, key = base64.b64decode(parts[4]), base64.b64decode(parts[5])
+    candidate = hashlib.scrypt(
+        password.encode(), salt=salt, n=n, r=r, p=p, maxmem=256 * n * r * p
+    )
+    current = (settings["SCRYPT_N"], settings["SCRYPT_R"], settings["SCRYPT_P"])
+    return hmac.compare_digest(candidate, key), (n, r, p) != current
+
+
+class PasswordHasher:
+    """
+    Runs scrypt in a bounded thread pool (hashlib releases the GIL), so logins
+    never block the event loop. Waiting work is capped per worker and per
+    key (client IP, username).
+    """
+
+    def __init__(self, workers, queue_size, per_key):
+        self.executor = ThreadPoolExecutor(workers, thread_name_prefix="password")
+        self.queue_size = queue_size
+        self.per_key = per_key
+        self.pending = 0
+        self.inflight = defaultdict(int)
+        self._dummy = None
+
+    @asynccontextmanager
+    async def _slot(self, keys):
+        if self.pending >= self.queue_size:
+            raise SanicException("Server is busy, try again later.", status_code=503)
+        if any(self.inflight[key] >= self.per_key for key in keys):
+            raise SanicException("Too many login attempts.", status_code=429)
+        self.pending += 1
+        for key in keys:
+            self.inflight[key] += 1
+        try:
+            yield
+        finally:
+            self.pending -= 1
+            for key in keys:
+                self.inflight[key] -= 1
+                if not self.inflight[key]:
+                    del self.inflight[key]
+
+    async def _run(self, keys, func, *args):
+        async with self._slot(keys):
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self.executor, func, *args)
+
+    async def hash(self, password, keys=()):
+        return await self._run(keys, hash_password, password)
+
+    async def verify(self, password, encoded, keys=()):
+        return await self._run(keys, verify_password, password, encoded)
+
+    async def verify_unknown(self, password, keys=()):
+        """Costs as much as verify() for a user that doesn't exist, never valid."""
+        if self._dummy is None:
+            self._dummy = await self.hash(os.urandom(16).hex())
+        await self.verify(password, self._dummy, keys)
+        return False, False
+
+
+password_hasher = PasswordHasher(
+    settings["PASSWORD_HASH_WORKERS"],
+    settings["PASSWORD_HASH_QUEUE"],
+    settings["LOGIN_MAX_INFLIGHT_PER_KEY"],
+)
@@ -0,0 +1,210 @@
+import asyncio
+import logging
+
+from sanic import json
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import sessionmaker
+
+from auth import decode_token, protected
+from cache import cache_backend
+
+logger = logging.getLogger(__name__)
+
+
+def parse_lsn(value):
+    """'16/B374D848' -> int, so WAL positions compare as numbers."""
+    high, low = value.split("/")
+    return (int(high, 16) << 32) | int(low, 16)
+
+
+def token_user_id(request):
+    token_info = decode_token(request)
+    return token_info.get("user_id") if token_info else None
+
+
+class Replica:
+    __slots__ = ("engine", "sessionmaker", "healthy", "lag", "replay_lsn", "picked")
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.sessionmaker = sessionmaker(
+            engine.execution_options(postgresql_readonly=True),
+            AsyncSession,
+            expire_on_commit=False,
+        )
+        # Unknown until the first check, reads stay on the primary meanwhile
+        self.healthy = False
+        self.lag = None
+        self.replay_lsn = 0
+        self.picked = 0
+
+    @property
+    def name(self):
+        return self.engine.url.render_as_string(hide_password=True)
+
+    def stats(self):
+        return {
+            "name": self.name,
+            "healthy": self.healthy,
+            "lag": self.lag,
+            "replay_lsn": self.replay_lsn,
+            "picked": self.picked,
+        }
+
+
+class ReplicaRouter:
+    """
+    Sends read-only requests to the least lagging healthy replica. After a
+    write the user's requests stay on the primary until a replica has replayed
+    it: the primary WAL position is kept per user in a cache, shared between
+    workers when it has a url.
+    """
+
+    def __init__(self, primary, engines, max_lag, check_timeout, sticky):
+        self.primary = primary
+        self.replicas = [Replica(engine) for engine in engines]
+        self.max_lag = max_lag
+        self.check_timeout = check_timeout
+        self.sticky = sticky
+        self.primary_reads = 0
+
+    async def _primary_lsn(self):
+        async with self.primary.connect() as conn:
+            result = await conn.execute(text("SELECT pg_current_wal_lsn()::text"))
+            return parse_lsn(result.scalar())
+
+    async def _check(self, replica, primary_lsn):
+        try:
+            async with replica.engine.connect() as conn:
+                result = await asyncio.wait_for(
+                    conn.execute(
+                        text(
+                            "SELECT pg_is_in_recovery(), "
+                            "pg_last_wal_replay_lsn()::text, "
+                            "EXTRACT(EPOCH FROM now() - "
+                            "pg_last_xact_replay_timestamp())"
+                        )
+                    ),
+                    self.check_timeout,
+                )
+                in_recovery, replay_lsn, replay_age = result.first()
+        except Exception:
+            if replica.healthy:
+                logger.exception("Replica %s is unavailable", replica.name)
+            replica.healthy = False
+            return
+
+        if not in_recovery or replay_lsn is None:
+            if replica.healthy:
+                logger.error("Replica %s is not in recovery", replica.name)
+            replica.healthy = False
+            return
+        replica.replay_lsn = parse_lsn(replay_lsn)
+        if primary_lsn is not None and replica.replay_lsn >= primary_lsn:
+            # Caught up, the age of the last replayed commit isn't lag
+            replica.lag = 0.0
+        else:
+            replica.lag = float(replay_age) if replay_age is not None else None
+        replica.healthy = replica.lag is not None
+
+    async def check(self):
+        try:
+            primary_lsn = await asyncio.wait_for(
+                self._primary_lsn(), self.check_timeout
+            )
+        except Exception:
+            logger.exception("Primary WAL position unavailable")
+            primary_lsn = None
+        await asyncio.gather(
+            *(self._check(replica, primary_lsn) for replica in self.replicas)
+        )
+
+    async def pick(self, request):
+        """A replica for a read-only request, None for the primary."""
+        candidates = [
+            replica
+            for replica in self.replicas
+            if replica.healthy and replica.lag <= self.max_lag
+        ]
+        user_id = token_user_id(request)
+        if candidates and user_id is not None:
+            written_lsn = await self.sticky.get(f"written_lsn:{user_id}")
+            if written_lsn:
+                candidates = [
+                    replica
+                    for replica in candidates
+                    if replica.replay_lsn >= written_lsn
+                ]
+        if not candidates:
+            self.primary_reads += 1
+            return None
+        # Whole seconds, so equally fresh replicas share the load
+        replica = min(candidates, key=lambda r: (int(r.lag), r.picked))
+        replica.picked += 1
+        return replica
+
+    async def remember_write(self, request):
+        """Called once the request's writes are committed."""
+        user_id = getattr(request.ctx, "writer_id", None) or token_user_id(request)
+        if user_id is None:
+            return
+        try:
+            lsn = await self._primary_lsn()
+            await self.sticky.set(f"written_lsn:{user_id}", lsn)
+        except Exception:
+            logger.exception("Can't record the write position of user %s", user_id)
+
+    def stats(self):
+        return {
+            "max_lag": self.max_lag,
+            "primary_reads": self.primary_reads,
+            "replicas": [replica.stats() for replica in self.replicas],
+        }
+
+
+def setup_replicas(app, primary, engines):
+    """Returns the router for setup_middlewares, None without replicas."""
+    if not engines:
+        return None
+    if app.config.WORKERS > 1 and not app.config.READ_YOUR_WRITES_CACHE_URL:
+        # A write handled by one worker must keep the user's reads on the
+        # primary in every worker
+        raise RuntimeError(
+            "DB_REPLICA_URLS with several WORKERS needs READ_YOUR_WRITES_CACHE_URL."
+        )
+    router = ReplicaRouter(
+        primary,
+        engines,
+        app.config.DB_REPLICA_MAX_LAG,
+        app.config.DB_REPLICA_CHECK_INTERVAL,
+        cache_backend(
+            app.config.READ_YOUR_WRITES_CACHE_URL,
+            app.config.AUTH_CACHE_SIZE,
+            app.config.READ_YOUR_WRITES_TTL,
+        ),
+    )
+
+    @app.after_server_start
+    async def start_replica_checks(app, loop):
+        async def check():
+            while True:
+                await router.check()
+                await asyncio.sleep(app.config.DB_REPLICA_CHECK_INTERVAL)
+
+        app.add_task(check(), name="replica_checks")
+
+    @app.after_server_stop
+    async def dispose_replicas(app, loop):
+        for replica in router.replicas:
+            await replica.engine.dispose()
+
+    @app.get("/stats/replicas")
+    @protected
+    async def replica_stats_endpoint(request):
+        if request.ctx.user.superuser:
+            return json(router.stats())
+        else:
+            return json({}, status=404)
+
+    return router
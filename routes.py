@@ -1,9 +1,24 @@
 from sanic import json
 from sanic.exceptions import SanicException
 
-from auth import protected
-from utils import validate_signature, prepare_signature, success_json
+from auth import protected, auth_cache_stats
+from serializers import json_response
+from utils import (
+    validate_signature,
+    normalize_payment,
+    prepare_signature,
+    success_json,
+    get_page_params,
+    wants_ndjson,
+    page_json,
+    cached_json,
+    stream_ndjson,
+    is_fresh,
+    not_modified,
+    version_headers,
+)
 from models import User
+from export import EXPORTS, ExportParams, exporter
 
 from db import *
 
@@ -16,7 +31,7 @@ def setup_routes(app):
 
     """
 
-    @app.get("/activate/<activate_link:str>")
+    @app.get("/activate/<activate_link:str>", ctx_writes=True)
     async def activate_user_endpoint(request, activate_link):
         user = await get_user_by_link(request, activate_link)
         if user:
@@ -27,15 +42,21 @@ def setup_routes(app):
     @app.get("/users/me")
     @protected
     async def get_current_user_endpoint(request):
+        version = await get_user_version(request, request.ctx.user.id)
+        if version and is_fresh(request, *version):
+            return not_modified(version_headers(version))
         user = await get_current_user(request)
-        return json(user.to_dict())
+        return json_response(user.to_dict(), headers=version_headers(version))
 
     @app.get("/users")
     @protected
     async def get_users_endpoint(request):
         if await is_super_user(request):
-            users = await get_users(request)
-            return json([user.to_dict() for user in users])
+            if wants_ndjson(request):
+                return await stream_ndjson(request, stream_users(request))
+            after_id, limit = get_page_params(request)
+            users = await get_users(request, after_id, limit)
+            return page_json(users, limit)
         else:
             return json({}, status=404)
 
@@ -82,10 +103,15 @@ def setup_routes(app):
     @app.get("/users/<id:int>")
     @protected
     async def get_user_endpoint(request, id):
+        version = await get_user_version(request, id)
+        if not version:
+            return json({}, status=404)
+        if is_fresh(request, *version):
+            return not_modified(version_headers(version))
         user = await get_user_by_id(request, id)
         if not user:
             return json({}, status=404)
-        return json(user.to_dict())
+        return json_response(user.to_dict(), headers=version_headers(version))
 
     """
     
@@ -96,9 +122,19 @@ def setup_routes(app):
     @app.get("/accounts/me")
     @protected
     async def get_current_user_accounts_endpoint(request):
-        user = await get_current_user(request)
+        user = request.ctx.user
+        version = await get_accounts_version(request, user.id)
+        if is_fresh(request, *version):
+            return not_modified(version_headers(version))
         accounts = await get_accounts_by_user(request, user)
-        return json([acc.to_dict() for acc in accounts])
+        return json_response(
+            [acc.to_dict() for acc in accounts], headers=version_headers(version)
+        )
+
+    @app.get("/accounts/me/summary")
+    @protected
+    async def get_current_user_accounts_summary_endpoint(request):
+        return json_response(await get_accounts_summary(request, request.ctx.user.id))
 
     """
     
@@ -106,12 +142,27 @@ def setup_routes(app):
     
     """
 
+    @app.get("/transactions/me/summary")
+    @protected
+    async def get_current_user_transactions_summary_endpoint(request):
+        summary = await get_user_totals(request, request.ctx.user.id)
+        if request.args.get("by_account"):
+            summary["accounts"] = await get_transactions_summary_by_account(
+                request, request.ctx.user.id
+            )
+        return json_response(summary)
+
     @app.get("/transactions/me")
     @protected
     async def get_current_user_transactions_endpoint(request):
-        user = await get_current_user(request)
-        transactions = await get_transactions_by_user(request, user)
-        return json([trx.to_dict() for trx in transactions])
+        user = request.ctx.user
+        if wants_ndjson(request):
+            return await stream_ndjson(
+                request, stream_transactions_by_user(request, user)
+            )
+        after_id, limit = get_page_params(request)
+        transactions = await get_transactions_by_user(request, user, after_id, limit)
+        return page_json(transactions, limit)
 
     """
 
@@ -122,15 +173,15 @@ def setup_routes(app):
     @app.get("/products")
     @protected
     async def get_products_endpoint(request):
-        prods = await get_products(request)
-        if not prods:
-            return json({})
-        return json([prod.to_dict() for prod in prods])
+        if wants_ndjson(request):
+            return await stream_ndjson(request, stream_products(request))
+        after_id, limit = get_page_params(request)
+        return cached_json(request, await get_cached_products(request, after_id, limit))
 
     @app.post("/products")
     @protected
     async def add_product_endpoint(request):
-        if is_super_user(request):
+        if await is_super_user(request):
             if request.json and all(
                 k in request.json for k in ("title", "description", "price")
             ):
@@ -154,8 +205,9 @@ def setup_routes(app):
     @protected
     async def delete_product_endpoint(request, id):
         if await is_super_user(request):
-            await delete_product(request, id)
-            return success_json()
+            if await delete_product(request, id):
+                return success_json()
+            return json({}, status=404)
         else:
             return json({}, status=404)
 
@@ -163,54 +215,40 @@ def setup_routes(app):
     @protected
     async def update_product_endpoint(request, id):
         if await is_super_user(request):
-            product = await get_product_by_id(request, id)
-            if product:
-                if request.json and all(
-                    k in request.json for k in ("title", "description", "price")
-                ):
-                    await update_product(
-                        request,
-                        id,
-                        request.json,
-                    )
-                    upd_prod = await get_product_by_id(request, id)
-                    return json(upd_prod.to_dict())
-                else:
-                    return SanicException(
-                        "title,description,price required.", status_code=500
-                    )
-            else:
+            if request.json and any(k in request.json for k in PRODUCT_FIELDS):
+                product = await update_product(request, id, request.json)
+                if product:
+                    return json_response(product)
                 return json({}, status=404)
+            else:
+                raise SanicException(
+                    "title, description or price required.", status_code=500
+                )
         else:
             return json({}, status=404)
 
     @app.get("/products/<id:int>")
     @protected
     async def get_product_endpoint(request, id):
-        prod = await get_product_by_id(request, id)
+        prod = await get_cached_product(request, id)
         if not prod:
             return json({}, status=404)
-        return json(prod.to_dict())
+        return cached_json(request, prod)
 
     @app.post("/products/buy/<id:int>")
     @protected
     async def buy_product_endpoint(request, id):
         if request.json:
             account_id = request.json.get("account_id")
-            product = await get_product_by_id(request, id)
-            if account_id and product:
-                account = await get_account_by_id(request, account_id)
-                user = await get_current_user(request)
-                if (
-                    account
-                    and account.user_id == user.id
-                    and product.price <= account.balance
-                ):
-                    new_balance = account.balance - product.price
-                    await update_account(request, id, new_balance)
-                    return json({"success": "true"})
-                else:
-                    raise SanicException("Wrong account.", status_code=500)
+            if account_id:
+                purchase = await buy_product(
+                    request, request.ctx.user.id, account_id, id
+                )
+                if purchase:
+                    return json({"success": "true", "purchase": purchase.to_dict()})
+                if not await get_product_by_id(request, id):
+                    return json({}, status=404)
+                raise SanicException("Wrong account.", status_code=500)
             else:
                 raise SanicException(
                     "Account id and product id required.", status_code=500
@@ -219,17 +257,122 @@ def setup_routes(app):
 
     """
 
+    Export
+
+    """
+
+    @app.get("/export/<name:str>")
+    @protected
+    async def export_endpoint(request, name):
+        if name in EXPORTS and await is_super_user(request):
+            params = ExportParams.from_request(request, name)
+            return await exporter.stream(request, params)
+        else:
+            return json({}, status=404)
+
+    """
+
+    Health
+
+    """
+
+    @app.get("/health/live")
+    async def health_live_endpoint(request):
+        return success_json()
+
+    @app.get("/health/ready")
+    async def health_ready_endpoint(request):
+        if getattr(request.app.ctx, "ready", False):
+            return success_json()
+        return json({"success": "false"}, status=503)
+
+    """
+
+    Stats
+
+    """
+
+    @app.get("/stats/auth-cache")
+    @protected
+    async def auth_cache_stats_endpoint(request):
+        if await is_super_user(request):
+            return json(auth_cache_stats())
+        else:
+            return json({}, status=404)
+
+    @app.get("/stats/product-cache")
+    @protected
+    async def product_cache_stats_endpoint(request):
+        if await is_super_user(request):
+            return json(product_cache.stats())
+        else:
+            return json({}, status=404)
+
+    @app.get("/stats/payment-buffer")
+    @protected
+    async def payment_buffer_stats_endpoint(request):
+        if app.config.PAYMENT_BUFFER and await is_super_user(request):
+            return json(app.ctx.payment_buffer.stats())
+        else:
+            return json({}, status=404)
+
+    """
+
     Payments
     
     """
 
     @app.post("/payment/webhook")
     async def payment_webhook_endpoint(request):
-        if request.json and validate_signature(app.config.SECRET, request.json):
-            result = await make_payment_webhook(request, request.json)
-            return json({"success": result})
+        payment = None
+        if isinstance(request.json, dict) and validate_signature(
+            app.config.SECRET, request.json
+        ):
+            payment = normalize_payment(request.json)
+        if payment:
+            if app.config.PAYMENT_BUFFER:
+                result = await app.ctx.payment_buffer.submit(payment)
+            else:
+                result = await make_payment_webhook(request, payment)
+            return json({"success": result is not None, "status": result})
         raise SanicException("Wrong json.", status_code=500)
 
+    @app.post("/payment/webhook/batch")
+    async def payment_webhook_batch_endpoint(request):
+        items = request.json
+        if (
+            not isinstance(items, list)
+            or not items
+            or len(items) > app.config.PAYMENT_BATCH_MAX
+        ):
+            raise SanicException("Wrong json.", status_code=500)
+
+        payments = [
+            normalize_payment(item)
+            if isinstance(item, dict) and validate_signature(app.config.SECRET, item)
+            else None
+            for item in items
+        ]
+        statuses = iter(
+            await make_payment_webhook_batch(request, [p for p in payments if p])
+        )
+        return json(
+            {
+                "success": True,
+                "results": [
+                    {
+                        "transaction_id": item.get("transaction_id")
+                        if isinstance(item, dict)
+                        else None,
+                        "status": (next(statuses) or "error")
+                        if payment
+                        else "invalid_signature",
+                    }
+                    for item, payment in zip(items, payments)
+                ],
+            }
+        )
+
     if app.config.DEBUG:
 
         @app.post("/payment/webhook1")
@@ -0,0 +1,45 @@
+import json
+import time
+
+from sanic.response import raw
+
+from metrics import record_serialization
+from settings import settings
+
+
+def get_encoder(name=None):
+    """
+    Returns dumps(obj) -> bytes for JSON_ENCODER (orjson, ujson or json).
+    Without a name the fastest installed one is used.
+    """
+    if name in (None, "", "orjson"):
+        try:
+            import orjson
+
+            return orjson.dumps
+        except ImportError:
+            if name:
+                raise
+    if name in (None, "", "ujson"):
+        import ujson
+
+        return lambda obj: ujson.dumps(obj, ensure_ascii=False).encode()
+    if name == "json":
+        return lambda obj: json.dumps(
+            obj, ensure_ascii=False, separators=(",", ":")
+        ).encode()
+    raise ValueError(f"Unknown JSON encoder {name}.")
+
+
+dumps = get_encoder(settings["JSON_ENCODER"])
+
+
+def json_response(data, status=200, headers=None):
+    started = time.perf_counter()
+    body = dumps(data)
+    record_serialization(time.perf_counter() - started)
+    return raw(body, status=status, headers=headers, content_type="application/json")
+
+
+def rows_to_dicts(rows):
+    return [row._asdict() for row in rows]
@@ -4,19 +4,143 @@ from sqlalchemy.orm import sessionmaker
 from sqlalchemy.pool import NullPool
 
 import os
+import tempfile
 
 load_dotenv()
 
+
+def env_bool(name, default=False):
+    value = os.getenv(name)
+    if value is None:
+        return default
+    return value.lower() in ("1", "true", "yes", "on")
+
+
+def env_int(name, default):
+    value = os.getenv(name)
+    return int(value) if value else default
+
+
+def env_float(name, default):
+    value = os.getenv(name)
+    return float(value) if value else default
+
+
 settings = {
     "HOST": os.getenv("HOST"),
     "PORT": os.getenv("PORT"),
     "DEBUG": os.getenv("DEBUG"),
     "DB_URL": os.getenv("DB_URL"),
     "SECRET": os.getenv("SECRET_KEY"),
+    "WORKERS": env_int("WORKERS", 2),
+    "LOG_LEVEL": os.getenv("LOG_LEVEL") or "INFO",
+    "LOG_JSON": env_bool("LOG_JSON", True),
+    # SQL is logged from engine events through the log queue, never echo=True
+    "SQL_LOG_SAMPLE_RATE": env_float("SQL_LOG_SAMPLE_RATE", 0.0),
+    "SLOW_QUERY_MS": env_int("SLOW_QUERY_MS", 200),
+    "LOG_SQL_PARAMS": env_bool("LOG_SQL_PARAMS"),
+    # Pool sizes are per worker process
+    "DB_POOL": env_bool("DB_POOL", True),
+    "DB_POOL_SIZE": env_int("DB_POOL_SIZE", 10),
+    "DB_MAX_OVERFLOW": env_int("DB_MAX_OVERFLOW", 5),
+    "DB_POOL_TIMEOUT": env_int("DB_POOL_TIMEOUT", 30),
+    "DB_POOL_RECYCLE": env_int("DB_POOL_RECYCLE", 1800),
+    "DB_POOL_PRE_PING": env_bool("DB_POOL_PRE_PING", True),
+    "DB_POOL_WARMUP": env_int("DB_POOL_WARMUP", 2),
+    "DB_STATEMENT_CACHE_SIZE": env_int("DB_STATEMENT_CACHE_SIZE", 100),
+    # Comma separated, read-only requests go to them, see replicas.py
+    "DB_REPLICA_URLS": [
+        url.strip()
+        for url in os.getenv("DB_REPLICA_URLS", "").split(",")
+        if url.strip()
+    ],
+    "DB_REPLICA_MAX_LAG": env_float("DB_REPLICA_MAX_LAG", 5.0),
+    "DB_REPLICA_CHECK_INTERVAL": env_float("DB_REPLICA_CHECK_INTERVAL", 1.0),
+    # How long a user's reads wait for replicas to replay their own write
+    "READ_YOUR_WRITES_TTL": env_int("READ_YOUR_WRITES_TTL", 60),
+    "READ_YOUR_WRITES_CACHE_URL": os.getenv("READ_YOUR_WRITES_CACHE_URL"),
+    # One transaction per request, committed by the response middleware
+    "UNIT_OF_WORK": env_bool("UNIT_OF_WORK", True),
+    # Off when migrations run as a separate deploy step
+    "MIGRATE_ON_START": env_bool("MIGRATE_ON_START", True),
+    "AUTH_CACHE_SIZE": env_int("AUTH_CACHE_SIZE", 10000),
+    "AUTH_CACHE_TTL": env_int("AUTH_CACHE_TTL", 60),
+    "TOKEN_TTL": env_int("TOKEN_TTL", 900),
+    "TOKEN_VERSION_REFRESH": env_int("TOKEN_VERSION_REFRESH", 5),
+    # scrypt cost, changing it rehashes passwords on the next login
+    "SCRYPT_N": env_int("SCRYPT_N", 2**14),
+    "SCRYPT_R": env_int("SCRYPT_R", 8),
+    "SCRYPT_P": env_int("SCRYPT_P", 1),
+    "PASSWORD_HASH_WORKERS": env_int("PASSWORD_HASH_WORKERS", os.cpu_count() or 2),
+    "PASSWORD_HASH_QUEUE": env_int("PASSWORD_HASH_QUEUE", 64),
+    "LOGIN_MAX_INFLIGHT_PER_KEY": env_int("LOGIN_MAX_INFLIGHT_PER_KEY", 2),
+    "PAYMENT_BATCH_MAX": env_int("PAYMENT_BATCH_MAX", 1000),
+    # /payment/webhook credits in batches, acknowledged after their commit
+    "PAYMENT_BUFFER": env_bool("PAYMENT_BUFFER", False),
+    "PAYMENT_BUFFER_MAX_BATCH": env_int("PAYMENT_BUFFER_MAX_BATCH", 500),
+    "PAYMENT_BUFFER_MAX_LATENCY_MS": env_int("PAYMENT_BUFFER_MAX_LATENCY_MS", 20),
+    "PAYMENT_BUFFER_QUEUE": env_int("PAYMENT_BUFFER_QUEUE", 10000),
+    # orjson, ujson or json, the fastest installed one when empty
+    "JSON_ENCODER": os.getenv("JSON_ENCODER"),
+    "PAGE_SIZE": env_int("PAGE_SIZE", 100),
+    "PAGE_SIZE_MAX": env_int("PAGE_SIZE_MAX", 1000),
+    "STREAM_CHUNK_SIZE": env_int("STREAM_CHUNK_SIZE", 500),
+    # /export/<name>: rows per read transaction, exports at once per worker
+    "EXPORT_CHUNK_ROWS": env_int("EXPORT_CHUNK_ROWS", 50000),
+    "EXPORT_MAX_RUNNING": env_int("EXPORT_MAX_RUNNING", 2),
+    "EXPORT_GZIP_LEVEL": env_int("EXPORT_GZIP_LEVEL", 6),
+    # Range partitions of transaction by id, see partitions.py
+    "TRANSACTION_PARTITION_SIZE": env_int("TRANSACTION_PARTITION_SIZE", 1000000),
+    "TRANSACTION_PARTITIONS_AHEAD": env_int("TRANSACTION_PARTITIONS_AHEAD", 2),
+    "TRANSACTION_PARTITION_CHECK_INTERVAL": env_int(
+        "TRANSACTION_PARTITION_CHECK_INTERVAL", 300
+    ),
+    "TRANSACTION_ARCHIVE_DIR": os.getenv("TRANSACTION_ARCHIVE_DIR")
+    or os.path.join(os.path.dirname(os.path.abspath(__file__)), "archive"),
+    "TRANSACTION_ARCHIVE_KEEP": env_int("TRANSACTION_ARCHIVE_KEEP", 3),
+    # Rows per gzip member, a history page decompresses only the ones it needs
+    "TRANSACTION_ARCHIVE_BLOCK_ROWS": env_int("TRANSACTION_ARCHIVE_BLOCK_ROWS", 10000),
+    # Worker snapshots merged by /metrics
+    "METRICS_DIR": os.getenv("METRICS_DIR")
+    or os.path.join(tempfile.gettempdir(), "sanic-task-metrics"),
+    "METRICS_FLUSH_INTERVAL": env_int("METRICS_FLUSH_INTERVAL", 5),
+    # Empty url keeps the cache in the worker, redis://... shares it
+    "PRODUCT_CACHE_URL": os.getenv("PRODUCT_CACHE_URL"),
+    "PRODUCT_CACHE_SIZE": env_int("PRODUCT_CACHE_SIZE", 1024),
+    "PRODUCT_CACHE_TTL": env_int("PRODUCT_CACHE_TTL", 300),
+    # A worker-local cache misses the other workers' invalidations, so with
+    # several workers and no url its entries live at most this long
+    "LOCAL_CACHE_MAX_TTL": env_int("LOCAL_CACHE_MAX_TTL", 5),
 }
 
+
+def engine_options(config, url=None):
+    url = url or config["DB_URL"]
+    if not config["DB_POOL"]:
+        return {"poolclass": NullPool}
+    options = {
+        "pool_size": config["DB_POOL_SIZE"],
+        "max_overflow": config["DB_MAX_OVERFLOW"],
+        "pool_timeout": config["DB_POOL_TIMEOUT"],
+        "pool_recycle": config["DB_POOL_RECYCLE"],
+        "pool_pre_ping": config["DB_POOL_PRE_PING"],
+    }
+    if url.startswith("postgresql+asyncpg"):
+        options["connect_args"] = {
+            "prepared_statement_cache_size": config["DB_STATEMENT_CACHE_SIZE"]
+        }
+    return options
+
+
 bind = create_async_engine(
-    settings["DB_URL"], future=True, echo=True, poolclass=NullPool
+    settings["DB_URL"],
+    future=True,
+    **engine_options(settings),
 )
 
+replica_binds = [
+    create_async_engine(url, future=True, **engine_options(settings, url))
+    for url in settings["DB_REPLICA_URLS"]
+]
+
 async_session_factory = sessionmaker(bind, AsyncSession)
@@ -0,0 +1,6 @@
+import os
+import sys
+
+# settings.py reads the environment on import, the tests don't need a server
+os.environ.setdefault("DB_URL", "postgresql+asyncpg://localhost/test")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
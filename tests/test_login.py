@@ -0,0 +1,17 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+from sanic.exceptions import SanicException
+
+from login import auth
+from passwords import verify_password
+
+
+@pytest.mark.parametrize("password", [12345, ["a"], {"a": 1}, True])
+def test_non_string_password_is_a_wrong_password(password):
+    request = SimpleNamespace(ip="127.0.0.1")
+    with pytest.raises(SanicException) as error:
+        asyncio.run(auth(request, "username", password))
+    assert error.value.args[0] == "Wrong username or password."
+    assert verify_password(password, "plain") == (False, False)
@@ -0,0 +1,103 @@
+import asyncio
+
+from middlewares import LazySession
+
+
+class FakeSession:
+    def __init__(self, events):
+        self.events = events
+
+    def in_transaction(self):
+        return True
+
+    async def execute(self, statement):
+        self.events.append("execute")
+
+    async def commit(self):
+        self.events.append("commit")
+
+    async def rollback(self):
+        self.events.append("rollback")
+
+    async def close(self):
+        self.events.append("close")
+
+
+def make_session(events, **kwargs):
+    return LazySession(lambda: FakeSession(events), unit_of_work=True, **kwargs)
+
+
+def test_after_commit_runs_after_commit():
+    events = []
+
+    async def invalidate():
+        events.append("invalidate")
+
+    async def main():
+        session = make_session(events)
+        await session.execute("UPDATE")
+        await session.after_commit(invalidate)
+        assert events == ["execute"]
+        await session.finish(commit=True)
+
+    asyncio.run(main())
+    assert events == ["execute", "commit", "close", "invalidate"]
+
+
+def test_after_commit_skipped_on_rollback():
+    events = []
+
+    async def main():
+        session = make_session(events)
+        await session.execute("UPDATE")
+        await session.after_commit(lambda: events.append("invalidate"))
+        await session.finish(commit=False)
+
+    asyncio.run(main())
+    assert events == ["execute", "rollback", "close"]
+
+
+def test_after_commit_error_is_logged(caplog):
+    events = []
+
+    def broken():
+        raise RuntimeError("cache is down")
+
+    async def main():
+        session = make_session(events)
+        await session.execute("UPDATE")
+        await session.after_commit(broken)
+        await session.after_commit(lambda: events.append("invalidate"))
+        await session.finish(commit=True)
+
+    asyncio.run(main())
+    assert events == ["execute", "commit", "close", "invalidate"]
+    assert "After commit callback" in caplog.text
+
+
+def test_after_commit_without_unit_of_work_runs_at_once(caplog):
+    events = []
+
+    def broken():
+        raise RuntimeError("cache is down")
+
+    async def main():
+        session = LazySession(lambda: FakeSession(events))
+        await session.after_commit(broken)
+        await session.after_commit(lambda: events.append("invalidate"))
+
+    asyncio.run(main())
+    assert events == ["invalidate"]
+    assert "After commit callback" in caplog.text
+
+
+def test_committed_only_after_a_commit():
+    async def main(commit):
+        session = make_session([])
+        await session.execute("UPDATE")
+        await session.finish(commit=commit)
+        return session.committed
+
+    assert asyncio.run(main(True)) is True
+    assert asyncio.run(main(False)) is False
+    assert make_session([]).committed is False
@@ -0,0 +1,172 @@
+import asyncio
+import os
+import re
+
+import pytest
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import create_async_engine
+
+from models import Base
+from partitions import (
+    ArchiveWriter,
+    _read_block,
+    ensure_partitions,
+    is_partitioned,
+    iter_archive,
+    partition_table,
+)
+
+TEST_DB_URL = os.getenv("TEST_DB_URL")
+
+
+class FakeResult:
+    def __init__(self, rows):
+        self.rows = rows
+
+    def first(self):
+        return self.rows[0] if self.rows else None
+
+    def scalar(self):
+        return self.rows[0][0] if self.rows else None
+
+    def __iter__(self):
+        return iter(self.rows)
+
+
+class FakeConn:
+    """The catalog and the transaction table, as far as maintenance reads them."""
+
+    def __init__(self, ids=(), partitions=(), relkind=b"p"):
+        self.ids = list(ids)
+        # As asyncpg returns the "char" column
+        self.relkind = relkind
+        self.partitions = {
+            f"transaction_p{lower}": (lower, upper) for lower, upper in partitions
+        }
+        self.statements = []
+
+    async def execute(self, statement, params=None):
+        sql = str(statement)
+        self.statements.append(sql)
+        if "FROM pg_class" in sql:
+            if sql.startswith("SELECT relkind = 'p'"):
+                return FakeResult([(self.relkind == b"p",)])
+            return FakeResult([(self.relkind,)])
+        if "FROM pg_inherits" in sql:
+            return FakeResult(
+                [
+                    (name, f"FOR VALUES FROM ({lower}) TO ({upper})")
+                    for name, (lower, upper) in self.partitions.items()
+                ]
+            )
+        if sql.startswith("SELECT min(id), max(id)"):
+            return FakeResult(
+                [(min(self.ids, default=None), max(self.ids, default=None))]
+            )
+        match = re.search(
+            r"ATTACH PARTITION (\w+) FOR VALUES FROM \((\d+)\) TO \((\d+)\)", sql
+        )
+        if match:
+            name, lower, upper = match.groups()
+            self.partitions[name] = (int(lower), int(upper))
+        return FakeResult([])
+
+
+def created(conn, **kwargs):
+    return asyncio.run(ensure_partitions(conn, **kwargs))
+
+
+def test_partitions_ahead_of_the_highest_id():
+    conn = FakeConn(ids=[5, 1500])
+    assert created(conn, size=1000, ahead=2) == [
+        "transaction_p0",
+        "transaction_p1000",
+        "transaction_p2000",
+        "transaction_p3000",
+    ]
+
+
+def test_partition_creation_is_idempotent():
+    conn = FakeConn(ids=[5, 1500])
+    created(conn, size=1000, ahead=2)
+    statements = len(conn.statements)
+    assert created(conn, size=1000, ahead=2) == []
+    assert created(conn, size=1000, ahead=2) == []
+    assert not any(
+        "CREATE TABLE transaction_p" in sql for sql in conn.statements[statements:]
+    )
+    assert sorted(lower for lower, _ in conn.partitions.values()) == [
+        0,
+        1000,
+        2000,
+        3000,
+    ]
+
+
+def test_new_partitions_follow_the_ids():
+    conn = FakeConn(ids=[1], partitions=[(0, 1000), (1000, 2000)])
+    assert created(conn, size=1000, ahead=1) == []
+    conn.ids.append(1200)
+    assert created(conn, size=1000, ahead=1) == ["transaction_p2000"]
+
+
+async def _read_all(path):
+    return [row async for rows in iter_archive(path, 2) for row in rows]
+
+
+def test_archive_blocks_are_read_alone(tmp_path):
+    path = str(tmp_path / "transaction_p0.csv.gz")
+    with open(path, "wb") as file:
+        writer = ArchiveWriter(file)
+        writer.write([(1, 10, 5.0), (2, None, 1.0), (3, 11, 2.0)])
+        writer.write([(7, 10, 3.0), (8, 12, 4.0)])
+    assert [block[3:] for block in writer.blocks] == [(1, 3), (7, 8)]
+    assert writer.bills[10] == [2, 8.0, {0, 1}]
+    assert writer.runs == [[1, 3], [7, 8]]
+    _, offset, length, _, _ = writer.blocks[1]
+    assert _read_block(path, offset, length) == [(7, 10, 3.0), (8, 12, 4.0)]
+    # Still one CSV file for sequential readers
+    assert [row[0] for row in asyncio.run(_read_all(path))] == [1, 2, 3, 7, 8]
+
+
+def test_partitioned_table_is_not_wrapped_again():
+    conn = FakeConn()
+    asyncio.run(partition_table(conn))
+    assert not any("RENAME" in sql for sql in conn.statements)
+
+
+@pytest.mark.skipif(not TEST_DB_URL, reason="TEST_DB_URL is not set")
+def test_is_partitioned_reads_the_catalog():
+    async def check():
+        engine = create_async_engine(TEST_DB_URL)
+        try:
+            async with engine.connect() as conn:
+                trx = await conn.begin()
+                await conn.execute(text("CREATE SCHEMA partitions_test"))
+                await conn.execute(text("SET LOCAL search_path TO partitions_test"))
+                await conn.run_sync(Base.metadata.create_all)
+                partitioned = await is_partitioned(conn)
+                await partition_table(conn)
+                result = await conn.execute(
+                    text("SELECT to_regclass('partitions_test.transaction_p0')")
+                )
+                wrapped = result.scalar()
+                await trx.rollback()
+        finally:
+            await engine.dispose()
+        return partitioned, wrapped
+
+    assert asyncio.run(check()) == (True, None)
+
+
+def test_default_partition_is_locked_while_rows_move():
+    conn = FakeConn(ids=[1])
+    created(conn, size=1000, ahead=0)
+    lock = next(
+        i
+        for i, sql in enumerate(conn.statements)
+        if "LOCK TABLE transaction_default" in sql
+    )
+    move = next(i for i, sql in enumerate(conn.statements) if "DELETE FROM" in sql)
+    assert "SHARE ROW EXCLUSIVE" in conn.statements[lock]
+    assert lock < move
@@ -0,0 +1,196 @@
+import asyncio
+from contextlib import asynccontextmanager
+from types import SimpleNamespace
+
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.sql.expression import Select, TextClause
+
+from db import (
+    apply_payment_batch,
+    get_accounts_version,
+    make_payment_webhook,
+    make_payment_webhook_batch,
+    payment_statement,
+)
+from middlewares import LazySession
+from utils import normalize_payment
+
+
+class FakeResult:
+    def __init__(self, rows):
+        self.rows = rows
+
+    def all(self):
+        return self.rows
+
+    def scalars(self):
+        return SimpleNamespace(all=lambda: [row[0] for row in self.rows])
+
+    def __iter__(self):
+        return iter(self.rows)
+
+
+class FakePaymentSession:
+    """Keeps transaction ids and account balances, enough for the batch path."""
+
+    def __init__(self, existing=(), poison=None, archived_runs=()):
+        self.transactions = set(existing)
+        self.balances = {}
+        self.poison = poison
+        self.archived_runs = sorted(archived_runs)
+        self.locks = []
+
+    async def execute(self, stmt, params=None):
+        if isinstance(stmt, TextClause):
+            self.locks.append(params["bucket"])
+            return FakeResult([])
+        if isinstance(stmt, Select):
+            assert self.locks, "archived ids looked up before the lock"
+            return FakeResult(self.archived_runs)
+        params = stmt.compile(dialect=postgresql.dialect()).params
+        rows = sorted(
+            (int(key[4:]), value)
+            for key, value in params.items()
+            if key.startswith("id_m")
+        )
+        ids = [value for _, value in rows]
+        if stmt.table.name == "transaction":
+            if self.poison in ids:
+                raise RuntimeError("constraint violation")
+            inserted = [id for id in ids if id not in self.transactions]
+            self.transactions.update(inserted)
+            return FakeResult([(id,) for id in inserted])
+        if stmt.table.name == "account":
+            self.account_ids = ids
+            for index, id in enumerate(ids):
+                self.balances[id] = (
+                    self.balances.get(id, 0) + params[f"balance_m{index}"]
+                )
+            return FakeResult([(id, 1) for id in ids])
+        return FakeResult([])
+
+    def in_transaction(self):
+        return True
+
+    @asynccontextmanager
+    async def begin_nested(self):
+        yield
+
+
+def payment(transaction_id, bill_id=1, amount=10):
+    return normalize_payment(
+        {
+            "transaction_id": transaction_id,
+            "user_id": 1,
+            "bill_id": bill_id,
+            "amount": amount,
+        }
+    )
+
+
+def test_normalize_payment():
+    assert payment("5", "2", "1.5") == {
+        "transaction_id": 5,
+        "user_id": 1,
+        "bill_id": 2,
+        "amount": 1.5,
+    }
+    assert payment("x") is None
+    assert payment(1.5) is None
+    assert payment(True) is None
+    assert payment(1, amount="nan") is None
+
+
+def test_string_and_int_ids_are_one_transaction():
+    session = FakePaymentSession()
+    items = [payment("5", bill_id="10"), payment(5, bill_id=10), payment(6, "2")]
+    statuses = asyncio.run(apply_payment_batch(session, items))
+    assert statuses == ["credited", "duplicate", "credited"]
+    # Sorted as ints, the account rows are locked in one order
+    assert session.account_ids == [2, 10]
+    assert session.balances == {2: 10, 10: 10}
+
+
+def test_already_applied_id_is_duplicate():
+    session = FakePaymentSession(existing={5})
+    statuses = asyncio.run(apply_payment_batch(session, [payment(5), payment(6)]))
+    assert statuses == ["duplicate", "credited"]
+    assert session.balances == {1: 10}
+
+
+def test_failed_batch_is_applied_one_by_one():
+    session = FakePaymentSession(existing={5}, poison=7)
+    request = SimpleNamespace(
+        ctx=SimpleNamespace(session=LazySession(lambda: session, unit_of_work=True))
+    )
+    items = [payment(5), payment(6), payment(7), payment(8), payment(6)]
+    statuses = asyncio.run(make_payment_webhook_batch(request, items))
+    assert statuses == ["duplicate", "credited", None, "credited", "duplicate"]
+    assert session.transactions == {5, 6, 8}
+
+
+def test_archived_ids_are_duplicates():
+    session = FakePaymentSession(archived_runs=[(1, 100), (200, 300)])
+    items = [payment("50"), payment(150), payment(300), payment(301)]
+    statuses = asyncio.run(apply_payment_batch(session, items))
+    assert statuses == ["duplicate", "credited", "duplicate", "credited"]
+    assert session.transactions == {150, 301}
+    assert session.balances == {1: 20}
+
+
+def test_batch_of_archived_ids_only():
+    session = FakePaymentSession(archived_runs=[(1, 100)])
+    statuses = asyncio.run(apply_payment_batch(session, [payment(5), payment("5")]))
+    assert statuses == ["duplicate", "duplicate"]
+    assert session.transactions == set()
+
+
+def test_single_payment_updates_the_totals():
+    sql = str(payment_statement(payment(5)).compile(dialect=postgresql.dialect()))
+    assert "INSERT INTO user_totals" in sql
+    assert "version = (user_totals.version +" in sql
+
+
+class FakeTotalsSession:
+    """user_totals.version of one user, bumped as far as the SQL does it."""
+
+    def __init__(self):
+        self.transactions = set()
+        self.version = 3
+
+    async def execute(self, stmt, params=None):
+        if isinstance(stmt, TextClause):
+            return FakeResult([])
+        compiled = stmt.compile(dialect=postgresql.dialect())
+        sql = str(compiled)
+        if sql.startswith("WITH trx AS"):
+            trx_id = compiled.params["param_1"]
+            if trx_id in self.transactions:
+                return SimpleNamespace(first=lambda: None)
+            self.transactions.add(trx_id)
+            if "version = (user_totals.version +" in sql:
+                self.version += 1
+            return SimpleNamespace(first=lambda: (1, 10.0, self.version))
+        return SimpleNamespace(scalar=lambda: self.version)
+
+    def in_transaction(self):
+        return True
+
+    @asynccontextmanager
+    async def begin_nested(self):
+        yield
+
+
+def test_webhook_changes_the_accounts_etag():
+    session = FakeTotalsSession()
+    request = SimpleNamespace(
+        ctx=SimpleNamespace(session=LazySession(lambda: session, unit_of_work=True))
+    )
+
+    async def credit(transaction_id):
+        before = await get_accounts_version(request, 1)
+        status = await make_payment_webhook(request, payment(transaction_id))
+        return status, before.etag != (await get_accounts_version(request, 1)).etag
+
+    assert asyncio.run(credit(5)) == ("credited", True)
+    assert asyncio.run(credit(5)) == ("duplicate", False)
@@ -0,0 +1,130 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+from cache import LocalCacheBackend
+from middlewares import LazySession
+from replicas import ReplicaRouter, setup_replicas
+
+
+class FakeEngine:
+    def __init__(self, name):
+        self.name = name
+
+    def execution_options(self, **options):
+        return self
+
+
+def make_request(user_id=None):
+    if user_id is None:
+        return SimpleNamespace(token=None, ctx=SimpleNamespace())
+    # decode_token returns the token already decoded for the request
+    return SimpleNamespace(
+        token="token", ctx=SimpleNamespace(token_info={"user_id": user_id})
+    )
+
+
+def make_router(primary_lsn, *replay_lsns):
+    router = ReplicaRouter(
+        FakeEngine("primary"),
+        [FakeEngine(f"replica{i}") for i in range(len(replay_lsns))],
+        max_lag=5.0,
+        check_timeout=1.0,
+        sticky=LocalCacheBackend(),
+    )
+    for replica, replay_lsn in zip(router.replicas, replay_lsns):
+        replica.healthy = True
+        replica.lag = 0.0
+        replica.replay_lsn = replay_lsn
+
+    async def current_lsn():
+        return primary_lsn
+
+    router._primary_lsn = current_lsn
+    return router
+
+
+def test_reads_follow_the_users_own_write():
+    router = make_router(100, 90, 100)
+
+    async def main():
+        await router.remember_write(make_request(user_id=1))
+        own = [await router.pick(make_request(user_id=1)) for _ in range(3)]
+        other = [await router.pick(make_request(user_id=2)) for _ in range(4)]
+        return own, other
+
+    own, other = asyncio.run(main())
+    assert {replica.engine.name for replica in own} == {"replica1"}
+    # Other users aren't held back by the write
+    assert "replica0" in {replica.engine.name for replica in other}
+
+
+def test_reads_stay_on_primary_until_replayed():
+    router = make_router(100, 90)
+
+    async def main():
+        await router.remember_write(make_request(user_id=1))
+        before = await router.pick(make_request(user_id=1))
+        router.replicas[0].replay_lsn = 100
+        after = await router.pick(make_request(user_id=1))
+        return before, after
+
+    before, after = asyncio.run(main())
+    assert before is None
+    assert after is router.replicas[0]
+    assert router.primary_reads == 1
+
+
+def test_writer_id_of_an_anonymous_request():
+    router = make_router(100, 90)
+    request = make_request()
+    request.ctx.writer_id = 1
+
+    async def main():
+        await router.remember_write(request)
+        return await router.pick(make_request(user_id=1))
+
+    assert asyncio.run(main()) is None
+
+
+def test_replica_is_picked_on_first_transaction_only():
+    picks = []
+
+    async def route():
+        picks.append(1)
+        return "replica"
+
+    async def main():
+        session = LazySession("primary", unit_of_work=True, route=route)
+        assert picks == []
+        async with session.transaction():
+            pass
+        async with session.transaction():
+            pass
+        return session._factory
+
+    assert asyncio.run(main()) == "replica"
+    assert picks == [1]
+
+
+def test_use_primary_skips_the_replica():
+    async def route():
+        raise AssertionError("no replica for cache fills")
+
+    async def main():
+        session = LazySession("primary", unit_of_work=True, route=route)
+        await session.use_primary()
+        async with session.transaction():
+            pass
+        return session._factory
+
+    assert asyncio.run(main()) == "primary"
+
+
+def test_replicas_need_a_shared_sticky_store():
+    app = SimpleNamespace(
+        config=SimpleNamespace(WORKERS=2, READ_YOUR_WRITES_CACHE_URL=None)
+    )
+    with pytest.raises(RuntimeError):
+        setup_replicas(app, FakeEngine("primary"), [FakeEngine("replica")])
@@ -1,26 +1,128 @@
+import heapq
+import math
 import uuid
+from collections import namedtuple
+from email.utils import format_datetime, parsedate_to_datetime
 from Crypto.Hash import SHA1
-from sanic.response import json
+from sanic.exceptions import SanicException
+from sanic.response import json, raw, empty
+
+from serializers import dumps, json_response
 
 
 def success_json():
     return json({"success": "true"})
 
 
-def fake_encode_password(some_pass):
-    return some_pass
+def get_page_params(request):
+    """?after_id=&limit= for keyset pagination, limit is capped by PAGE_SIZE_MAX."""
+    try:
+        after_id = int(request.args.get("after_id", 0))
+        limit = int(request.args.get("limit", request.app.config.PAGE_SIZE))
+    except ValueError:
+        raise SanicException("after_id and limit must be integers.", status_code=400)
+    return after_id, max(1, min(limit, request.app.config.PAGE_SIZE_MAX))
+
+
+def wants_ndjson(request):
+    return request.args.get(
+        "format"
+    ) == "ndjson" or "application/x-ndjson" in request.headers.get("accept", "")
+
+
+def next_page_headers(items, limit):
+    if items and len(items) == limit:
+        return {"X-Next-After-Id": str(items[-1]["id"])}
+    return {}
+
+
+def page_json(items, limit):
+    return json_response(items, headers=next_page_headers(items, limit))
+
+
+ResourceVersion = namedtuple("ResourceVersion", ["etag", "last_modified"])
+
 
+def make_version(key, version):
+    """A version counter only validates by ETag, it has no Last-Modified."""
+    return ResourceVersion(f'"{key}-{version}"', None)
 
-def fake_decode_password(some_pass):
-    return some_pass
 
+def version_headers(version):
+    headers = {"ETag": version.etag}
+    if version.last_modified:
+        headers["Last-Modified"] = format_datetime(version.last_modified, usegmt=True)
+    return headers
 
-def check_hashed_pass(plain_password, encoded_pass):
-    if fake_encode_password(plain_password) == encoded_pass:
-        return True
+
+def is_fresh(request, etag, last_modified=None):
+    """If-None-Match wins over If-Modified-Since, as in RFC 7232."""
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match:
+        if if_none_match.strip() == "*":
+            return True
+        tags = [tag.strip() for tag in if_none_match.split(",")]
+        return etag in tags or f"W/{etag}" in tags
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since and last_modified:
+        try:
+            since = parsedate_to_datetime(if_modified_since)
+        except (TypeError, ValueError):
+            return False
+        return last_modified.replace(microsecond=0) <= since
     return False
 
 
+def not_modified(headers):
+    return empty(status=304, headers=headers)
+
+
+def cached_json(request, entry):
+    if is_fresh(request, entry.etag):
+        return not_modified({"ETag": entry.etag})
+    return raw(
+        entry.body,
+        content_type="application/json",
+        headers={"ETag": entry.etag, **entry.headers},
+    )
+
+
+async def stream_ndjson(request, rows):
+    """
+    Streams rows one JSON document per line. The rows generator opens its own
+    session after the response middleware ran, so it is closed here.
+    """
+    response = await request.respond(content_type="application/x-ndjson")
+    try:
+        async for row in rows:
+            await response.send(dumps(row) + b"\n")
+    finally:
+        await request.ctx.session.dispose()
+    await response.eof()
+
+
+async def merge_sorted(key, *sources):
+    """heapq.merge for async iterators, each already sorted by key."""
+    heap = []
+    for index, source in enumerate(sources):
+        source = source.__aiter__()
+        try:
+            item = await source.__anext__()
+        except StopAsyncIteration:
+            continue
+        heap.append((key(item), index, item, source))
+    heapq.heapify(heap)
+    while heap:
+        _, index, item, source = heap[0]
+        yield item
+        try:
+            item = await source.__anext__()
+        except StopAsyncIteration:
+            heapq.heappop(heap)
+        else:
+            heapq.heapreplace(heap, (key(item), index, item, source))
+
+
 def generate_uuid():
     return str(uuid.uuid4())
 
@@ -48,6 +150,32 @@ def validate_signature(secret_key, json_dict):
     return False
 
 
+def _payment_id(value):
+    # bool is an int, "1" is fine: the signature covers the string form
+    if isinstance(value, bool) or not isinstance(value, (int, str)):
+        raise ValueError(value)
+    return int(value)
+
+
+def normalize_payment(json_dict):
+    """
+    A signed webhook payload with int ids and a float amount, so payloads
+    sending "1" and 1 are the same transaction. None if malformed.
+    """
+    try:
+        amount = float(json_dict["amount"])
+        if not math.isfinite(amount):
+            return None
+        return {
+            "transaction_id": _payment_id(json_dict["transaction_id"]),
+            "user_id": _payment_id(json_dict["user_id"]),
+            "bill_id": _payment_id(json_dict["bill_id"]),
+            "amount": amount,
+        }
+    except (TypeError, ValueError):
+        return None
+
+
 def prepare_signature(secret_key, json_dict):
     signature = SHA1.new()
     signature.update(